@@ -16,7 +16,8 @@ def create_dict_results_total(dict_exps, folder_experiments, measure, how, norma
         tmp_results = []
         
         for exp_run in sorted_dict: 
-            df = pd.read_csv(glob(folder_experiments+sorted_dict[exp_run]+f"/{how}_measures.csv")[0])
+            columns = [measure, "edge_id"] if normalize_by is not None else [measure]
+            df = read_run_table(folder_experiments+sorted_dict[exp_run], f"{how}_measures", columns=columns)
             
             if normalize_by is not None:
                 
@@ -37,6 +38,66 @@ def create_dict_results_total(dict_exps, folder_experiments, measure, how, norma
     return dict_final
 
 
+def read_run_table(folder, name, columns=None):
+
+    # a table of a simulation run (e.g., edge_measures) reading only the given columns:
+    # from <name>.parquet (--output-format parquet) or from <name>.csv for the older runs
+    filename = f"{folder}/{name}.parquet"
+    if os.path.exists(filename):
+        return pd.read_parquet(filename, columns=columns)
+
+    return pd.read_csv(f"{folder}/{name}.csv", usecols=columns)
+
+
+def read_run_log(folder):
+
+    # log.json of a run, or the copy embedded in its parquet tables
+    if os.path.exists(f"{folder}/log.json"):
+        with open(f"{folder}/log.json") as json_file:
+            return json.load(json_file)
+
+    import pyarrow.parquet as pq
+    metadata = pq.read_schema(f"{folder}/edge_measures.parquet").metadata
+
+    return json.loads(metadata[b"traffico2"])
+
+
+def load_v_edge_matrix(filename):
+
+    # dense (edges x windows) matrix of the vehicles per edge from the sparse v_per_edges.npz (or .parquet)
+    if filename.endswith(".parquet"):
+        import pyarrow.parquet as pq
+        table = pq.read_table(filename)
+        n_windows = json.loads(table.schema.metadata[b"traffico2"])["v_edge"]["n_windows"]
+
+        edge_id = table.column("edge_id").combine_chunks()
+        edge_ids = [str(e) for e in edge_id.dictionary.to_pylist()]
+
+        matrix = np.zeros((len(edge_ids), n_windows), dtype=np.int64)
+        matrix[edge_id.indices.to_numpy(), table.column("window").to_numpy()] = table.column("count").to_numpy()
+
+        return edge_ids, matrix
+
+    data = np.load(filename)
+
+    matrix = np.zeros((len(data["edge_id"]), int(data["n_windows"])), dtype=np.int64)
+    matrix[data["edge"], data["window"]] = data["count"]
+
+    return list(data["edge_id"]), matrix
+
+
+def load_edge_emission_windows(filename):
+
+    # read-only (edges x windows x pollutants) memmap of edge_emissions_windowed.dat and its JSON header
+    with open(filename.replace(".dat", ".json")) as f:
+        header = json.load(f)
+
+    tensor = np.memmap(filename, dtype=header["dtype"], mode="r", shape=tuple(header["shape"]),
+                       order=header.get("order", "C"))
+
+    return header, tensor
+
+
 def create_dict_exps(folder_experiments, nav_str):
 
     dict_exps = {}
@@ -46,8 +107,7 @@ def create_dict_exps(folder_experiments, nav_str):
     for exp in folders:
 
         #retrieve sim parameters
-        with open(folder_experiments+"/"+exp+"/log.json") as json_file:
-            dict_json = json.load(json_file)
+        dict_json = read_run_log(folder_experiments+"/"+exp)
 
         demand_name = dict_json['route_filename'].split("/")[-1]
         pct_routed = demand_name.split(nav_str+"_")[1].split("_")[0]
@@ -85,7 +145,7 @@ def create_dict_results_co2(dict_exps, folder_experiments):
 
         map__simulation_type__df = {}
         for c_type, c_file_name in map__simulation_type__filename.items():
-            c_df = pd.read_csv(glob(folder_experiments+c_file_name+"/edge:measures.csv")[0])
+            c_df = read_run_table(folder_experiments+c_file_name, "edge_measures", columns=["edge_id", "total_co2"])
             map__simulation_type__df[c_type] = c_df.rename(columns={'total_co2': c_type})
 
         merged_df = merge([df for df in map__simulation_type__df.values()], on_columns='edge_id')
@@ -114,7 +174,7 @@ def create_dict_results_alpha(dict_exps, folder_experiments):
 
         map__simulation_type__df = {}
         for c_type, c_file_name in map__simulation_type__filename.items():
-            c_df = pd.read_csv(glob(folder_experiments+c_file_name+"/edge_measures.csv")[0])
+            c_df = read_run_table(folder_experiments+c_file_name, "edge_measures", columns=["edge_id", "total_co2"])
             c_df = c_df.rename(columns={'total_co2': c_type})
             map__simulation_type__df[c_type] = c_df[["edge_id",c_type]]
 
@@ -180,7 +240,7 @@ def create_dict_results_gini(dict_exps, folder_experiments):
 
         map__simulation_type__df = {}
         for c_type, c_file_name in map__simulation_type__filename.items():
-            c_df = pd.read_csv(glob(folder_experiments+c_file_name+"/edge_measures.csv")[0])
+            c_df = read_run_table(folder_experiments+c_file_name, "edge_measures", columns=["edge_id", "total_co2"])
             c_df = c_df.rename(columns={'total_co2': c_type})
             map__simulation_type__df[c_type] = c_df[["edge_id", c_type]]
 
@@ -214,8 +274,7 @@ def create_dict_exps_w(folder_experiments, nav_str):
     for exp in folders:
 
         #retrieve sim parameters
-        with open(folder_experiments+"/"+exp+"/log.json") as json_file:
-            dict_json = json.load(json_file)
+        dict_json = read_run_log(folder_experiments+"/"+exp)
 
         demand_name = dict_json['route_filename'].split("/")[-1]
         pct_routed = demand_name.split(nav_str+"_")[1].split("_")[0]
@@ -7,9 +7,14 @@ from math import sqrt, sin, cos, pi, asin
 import xml
 from xml.dom import minidom
 from itertools import groupby
+from multiprocessing import get_context
 import subprocess
 import folium
 import traci
+import sumolib
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import connected_components
+from scipy.spatial import cKDTree
 import os
 import sys
 import datetime
@@ -98,50 +103,63 @@ def gps_coordinate_of_edge(net, edge_id):
 def create_mobility_demand(n_veichles, dict_tile_edges, od_matrix, road_network, filename,
                            timing="start", time_range=(0, 3601), random_seed=None,
                            show_progress=False, vehicles_background=None, threshold_km=1,
-                           background_suffix="background_", vehicle_suffix="vehicle_", allow_self_tiles=True):
-    
-    departure_times = []
-    
-    # select n_veichles OD pairs from the od-matrix
-    od_pairs, choices = create_traffic_from_matrix(od_matrix, dict_tile_edges, n_veichles, road_network, 
-                                                threshold_km=threshold_km, allow_self_tiles=allow_self_tiles,
-                                                show_progress=show_progress, random_seed=random_seed)
-    
-    dict_mobility_demand = {}
+                           background_suffix="background_", vehicle_suffix="vehicle_", allow_self_tiles=True,
+                           reachability=None, n_workers=1, chunk_size=1000):
 
-    for ind, el in enumerate(od_pairs):
-        if timing == "start":
-            def_time = 0
-            departure_times.append(def_time)
-        elif timing == "uniform_range":
-            def_time = np.random.randint(time_range[0], time_range[1])
-            departure_times.append(def_time)
+    # the vehicles (and each cohort of background vehicles) are generated in chunks of chunk_size vehicles,
+    # each one with its own np.random.Generator spawned from the SeedSequence of random_seed:
+    # for a given random_seed the demand is the same with any n_workers
+    seed_entropy = np.random.SeedSequence(random_seed).entropy
 
-        dict_mobility_demand[vehicle_suffix+str(ind)] = {'edges':el, 'time': def_time,
-                              'via': False, 'number':1, 'dt':10}
-    
-    # create Background Traffic
-    if vehicles_background is not None:
+    # lon/lat of the edges of each tile, shared by all the draws
+    edge_coords = create_edge_coordinates(road_network, dict_tile_edges)
 
-        if random_seed is not None:
-                np.random.seed(random_seed)
+    # route validation without SUMO (load_reachability_index caches the index of a network file)
+    if reachability is None:
+        reachability = create_reachability_index(road_network)
 
-        for ind0, elem in enumerate(vehicles_background):
+    context = {"od_matrix": od_matrix, "dict_tile_edges": dict_tile_edges, "edge_coords": edge_coords,
+               "reachability": reachability, "threshold_km": threshold_km, "allow_self_tiles": allow_self_tiles,
+               "seed_entropy": seed_entropy}
 
-            bg_t_start, bg_t_end = elem[1][0], elem[1][1]
+    # tasks (cohort, chunk, n vehicles, departure range), cohort 0 are the vehicles, 1.. the background cohorts
+    time_range_vehicles = time_range if timing == "uniform_range" else None
 
-            r_seed = np.random.randint(0,9999999)
+    cohorts = [(n_veichles, time_range_vehicles)]
+    if vehicles_background is not None:
+        cohorts += [(elem[0], (elem[1][0], elem[1][1]+1)) for elem in vehicles_background]
 
-            od_pairs_bg, choices_bg = create_traffic_from_matrix(od_matrix, dict_tile_edges, elem[0], road_network, 
-                allow_self_tiles=allow_self_tiles, threshold_km=threshold_km, show_progress=False, random_seed=r_seed)
+    tasks = [(cohort, chunk, min(chunk_size, n-chunk*chunk_size), t_range) for cohort, (n, t_range) in enumerate(cohorts)
+             for chunk in range((n+chunk_size-1)//chunk_size)]
 
-            for ind, el in enumerate(od_pairs_bg):
-                def_time = np.random.randint(bg_t_start, bg_t_end+1)
+    if n_workers > 1 and len(tasks) > 1:
+        with get_context("spawn").Pool(processes=min(n_workers, len(tasks)), initializer=init_demand_worker,
+                                       initargs=(context,)) as pool:
+            results = list(tqdm(pool.imap(create_demand_chunk, tasks), total=len(tasks), disable=not show_progress))
+    else:
+        init_demand_worker(context)
+        results = [create_demand_chunk(task) for task in tqdm(tasks, disable=not show_progress)]
 
-                dict_mobility_demand[background_suffix+str(ind0)+"_"+str(ind)] = {'edges':el, 'time': def_time,
+    od_pairs, departure_times = [], []
+    dict_mobility_demand = {}
+    cohort_pairs = {}
+
+    for (cohort, chunk, n, t_range), (od_pairs_chunk, times_chunk) in zip(tasks, results):
+        cohort_pairs.setdefault(cohort, []).extend(zip(od_pairs_chunk, times_chunk))
+
+    for ind, (el, def_time) in enumerate(cohort_pairs.get(0, [])):
+        od_pairs.append(el)
+        departure_times.append(def_time)
+        dict_mobility_demand[vehicle_suffix+str(ind)] = {'edges':el, 'time': def_time,
                               'via': False, 'number':1, 'dt':10}
 
-    res = create_xml_flows(dict_mobility_demand, filename+".rou.xml")
+    # Background Traffic
+    for cohort in range(1, len(cohorts)):
+        for ind, (el, def_time) in enumerate(cohort_pairs.get(cohort, [])):
+            dict_mobility_demand[background_suffix+str(cohort-1)+"_"+str(ind)] = {'edges':el, 'time': def_time,
+                              'via': False, 'number':1, 'dt':10}
+
+    res = create_xml_flows(dict_mobility_demand, filename+".rou.xml", reachability=reachability)
 
     dict_mobility_demand_pairs = {k:{"edges":dict_mobility_demand[k]['edges'], 
     "time":dict_mobility_demand[k]['time']} for k in dict_mobility_demand.keys()}
@@ -149,7 +167,38 @@ def create_mobility_demand(n_veichles, dict_tile_edges, od_matrix, road_network,
     return od_pairs, departure_times, dict_mobility_demand_pairs
 
 
-def create_xml_flows(dict_flows={}, filename=None, check_validity=True):
+demand_context = None
+
+
+def init_demand_worker(context):
+
+    # data shared by the chunks of create_mobility_demand (set once per worker process)
+    global demand_context
+    demand_context = context
+
+
+def create_demand_chunk(task):
+
+    # OD pairs and departure times of one chunk of a cohort, drawn from the Generator of (cohort, chunk)
+    cohort, chunk, n, t_range = task
+    ctx = demand_context
+
+    rng = np.random.default_rng(np.random.SeedSequence(ctx["seed_entropy"], spawn_key=(cohort, chunk)))
+
+    od_pairs, choices = create_traffic_from_matrix(ctx["od_matrix"], ctx["dict_tile_edges"], n, None,
+                                                   threshold_km=ctx["threshold_km"], allow_self_tiles=ctx["allow_self_tiles"],
+                                                   show_progress=False, edge_coords=ctx["edge_coords"],
+                                                   reachability=ctx["reachability"], rng=rng)
+
+    if t_range is None:
+        departure_times = [0]*n
+    else:
+        departure_times = [int(t) for t in rng.integers(t_range[0], t_range[1], n)]
+
+    return od_pairs, departure_times
+
+
+def create_xml_flows(dict_flows={}, filename=None, check_validity=True, reachability=None):
     
     # xml creation
     root = minidom.Document()
@@ -189,7 +238,9 @@ def create_xml_flows(dict_flows={}, filename=None, check_validity=True):
             edge_list = [x[0] for x in groupby(edge_list)]
 
             if check_validity:
-                if not has_valid_route_traci(edge_list):
+                # with the reachability index (see create_reachability_index) or a running SUMO
+                valid = has_valid_route_index(reachability, edge_list) if reachability is not None else has_valid_route_traci(edge_list)
+                if not valid:
                     print("INVALID!")
                     invalid_list.append(traj_id)
                     continue
@@ -296,101 +347,104 @@ def create_xml_vehicles(dict_vehicles, filename):
 
 
 def create_traffic_from_matrix(od_matrix, dict_tile_edges, n_vehicles, road_network, threshold_km=1.2, max_tries=100, 
-                                choice="uniform", random_seed=None, allow_self_tiles=True, show_progress=True):
-    
-    if random_seed is not None:
-        np.random.seed(random_seed)
+                                choice="uniform", random_seed=None, allow_self_tiles=True, show_progress=True, edge_coords=None,
+                                reachability=None, rng=None):
+
+    # all the draws come from rng (a np.random.Generator), or from a new one seeded with random_seed
+    if rng is None:
+        rng = np.random.default_rng(random_seed)
         
-    if show_progress or True:
+    if show_progress:
          pbar = tqdm(total=n_vehicles) 
     
     # n_vehicles pairs in the form of (edge_start, edge_end)
     od_edges_list, choices_list = [], []
     
-    #init traci for fast route validation
-    try:
-        init_traci()
-    except traci.TraCIException:
-        pass
-    
-    size = od_matrix.shape[0]
-    
-    #random choice of tile_start, tile_end
-    weights = od_matrix.flatten()
+    #route validation with the reachability index of the road network
+    if reachability is None:
+        reachability = create_reachability_index(road_network)
+
+    #lon/lat of the edges of each tile
+    if edge_coords is None:
+        edge_coords = create_edge_coordinates(road_network, dict_tile_edges)
+
+    #random choice of tile_start, tile_end for all the vehicles at once
+    od_sampler = create_od_sampler(od_matrix, allow_self_tiles=allow_self_tiles)
+    origins, destinations = sample_od_pairs(od_sampler, n_vehicles, rng=rng)
     
     for v in range(n_vehicles):
         
         valid_od = False
+        o, d = int(origins[v]), int(destinations[v])
         
         #selection of a single OD pair
         while not valid_od:
 
-            tries = 0
-            #random choice of origin and destination tile
-
-            ind = random_weighted_choice(weights)
-            #convert ind in row and cols
-            tile_start, tile_end = str(int(ind/size)), str(ind%size)
-
-            if not allow_self_tiles:
-                while tile_start == tile_end:
-                    ind = random_weighted_choice(weights)
-                    tile_start, tile_end = str(int(ind/size)), str(ind%size)
-
-            #list of edges in origin and dest
-            edge_list_start = dict_tile_edges[tile_start]
-            edge_list_end = dict_tile_edges[tile_end]
-
-    
-            while tries < max_tries:
-                
-                ind_start = np.random.randint(0, len(edge_list_start))
-                ind_end = np.random.randint(0, len(edge_list_end))
-
-                edge_start = edge_list_start[ind_start]
-                edge_end = edge_list_end[ind_end]
-
-                # compute distance here
-                lon_o, lat_o = gps_coordinate_of_edge_avg(road_network, edge_start)
-                lon_d, lat_d = gps_coordinate_of_edge_avg(road_network, edge_end)
-                
-                d_km = distance_earth_km({"lat":lat_o, "lon":lon_o}, {"lat":lat_d, "lon":lon_d})
-                
-                if d_km >= threshold_km:
-
-                    if has_valid_route_traci([edge_start, edge_end]):
-                        od_edges_list.append([edge_start, edge_end])
-                        choices_list.append((int(ind/size), ind%size))
-                        tries=0
-                        if show_progress or True:
-                            pbar.update(1)
-                        valid_od = True
-                        break
-                else:
-                    tries+=1
+            #a new pair of tiles when no valid pair of edges has been found
+            if o < 0:
+                o, d = [int(t[0]) for t in sample_od_pairs(od_sampler, 1, rng=rng)]
 
-                if tries == max_tries:
+            tile_start, tile_end = str(o), str(d)
 
-                    edge_list_start_P = np.random.permutation(edge_list_start)
-                    edge_list_end_P = np.random.permutation(edge_list_end)
+            #edges (and their coordinates) in origin and dest
+            coords_start, coords_end = edge_coords[tile_start], edge_coords[tile_end]
+            n_start, n_end = len(coords_start["edges"]), len(coords_end["edges"])
 
-                    for edge_start, edge_end in ((e1, e2) for e1 in edge_list_start_P for e2 in edge_list_end_P):
-            
-                        lon_o, lat_o = gps_coordinate_of_edge_avg(road_network, edge_start)
-                        lon_d, lat_d = gps_coordinate_of_edge_avg(road_network, edge_end)
+            #max_tries random pairs of edges at once: the first one far enough and with a valid route is kept
+            ind_start = rng.integers(0, n_start, max_tries)
+            ind_end = rng.integers(0, n_end, max_tries)
+
+            d_km = distance_earth_km_array(coords_start["lat"][ind_start], coords_start["lon"][ind_start],
+                                           coords_end["lat"][ind_end], coords_end["lon"][ind_end])
+
+            for i in np.flatnonzero(d_km >= threshold_km):
+
+                edge_start, edge_end = coords_start["edges"][ind_start[i]], coords_end["edges"][ind_end[i]]
 
-                        d_km = distance_earth_km({"lat":lat_o, "lon":lon_o}, {"lat":lat_d, "lon":lon_d})
+                if has_valid_route_index(reachability, [edge_start, edge_end]):
+                    od_edges_list.append([edge_start, edge_end])
+                    choices_list.append((o, d))
+                    if show_progress:
+                        pbar.update(1)
+                    valid_od = True
+                    break
 
-                        if d_km >= threshold_km:
-                            if has_valid_route_traci([edge_start, edge_end]):
+            #otherwise all the pairs of edges far enough, in random order (from the spatial index of the dest tile)
+            if not valid_od:
 
-                                od_edges_list.append([edge_start, edge_end])
-                                choices_list.append((int(ind/size), ind%size))
+                perm_end = rng.permutation(n_end)
+                radius = chord_of_distance_km(threshold_km)
 
-                                if show_progress or True:
-                                    pbar.update(1)
-                                valid_od = True
-                                break
+                #number of dest edges closer than threshold_km to each start edge
+                n_near = coords_end["tree"].query_ball_point(coords_start["xyz"], radius, return_length=True)
+
+                for i in rng.permutation(n_start):
+
+                    if n_near[i] == n_end:
+                        continue
+
+                    far = np.ones(n_end, dtype=bool)
+                    far[coords_end["tree"].query_ball_point(coords_start["xyz"][i], radius)] = False
+
+                    for j in perm_end[far[perm_end]]:
+
+                        edge_start, edge_end = coords_start["edges"][i], coords_end["edges"][j]
+
+                        if has_valid_route_index(reachability, [edge_start, edge_end]):
+
+                            od_edges_list.append([edge_start, edge_end])
+                            choices_list.append((o, d))
+
+                            if show_progress:
+                                pbar.update(1)
+                            valid_od = True
+                            break
+
+                    if valid_od:
+                        break
+
+                if not valid_od:
+                    o = -1
                                          
     return od_edges_list, choices_list
 
@@ -412,6 +466,33 @@ def init_traci():
     traci.simulationStep()
     
 
+def create_od_sampler(od_matrix, allow_self_tiles=True):
+
+    # cumulative weights of the flattened OD matrix, built once per matrix;
+    # the self tiles are excluded by masking the diagonal
+    weights = np.array(od_matrix, dtype=np.float64)
+    if not allow_self_tiles:
+        np.fill_diagonal(weights, 0)
+
+    cum_weights = np.cumsum(weights.flatten())
+    if cum_weights[-1] <= 0:
+        raise ValueError("the OD matrix has no flow to sample from")
+
+    return {"cum_weights": cum_weights, "size": weights.shape[0]}
+
+
+def sample_od_pairs(od_sampler, n, rng=None):
+
+    # n (origin, destination) tile pairs drawn with probability proportional to the flows
+    if rng is None:
+        rng = np.random.default_rng()
+
+    cum_weights = od_sampler["cum_weights"]
+    ind = np.searchsorted(cum_weights, rng.random(n)*cum_weights[-1], side="right")
+
+    return ind // od_sampler["size"], ind % od_sampler["size"]
+
+
 def random_weighted_choice(weights):
         
     probabilities = weights/np.sum(weights)
@@ -431,6 +512,50 @@ def gps_coordinate_of_edge_avg(net, edge_id):
     return (lon+lon1)/2, (lat+lat1)/2
 
 
+def create_edge_coordinates(road_network, dict_tile_edges):
+
+    # lon/lat of the midpoint of the edges of each tile (as gps_coordinate_of_edge_avg), computed once:
+    # tile -> {"edges": edge ids, "lon": array, "lat": array, "xyz": unit vectors, "tree": KD-tree of xyz}
+    edge_ids = sorted({e for edges in dict_tile_edges.values() for e in edges})
+
+    xy_from = np.array([road_network.getEdge(e).getFromNode().getCoord() for e in edge_ids], dtype=np.float64).reshape(-1, 2)
+    xy_to = np.array([road_network.getEdge(e).getToNode().getCoord() for e in edge_ids], dtype=np.float64).reshape(-1, 2)
+
+    lon, lat = road_network.convertXY2LonLat(xy_from[:, 0], xy_from[:, 1])
+    lon1, lat1 = road_network.convertXY2LonLat(xy_to[:, 0], xy_to[:, 1])
+    lon, lat = (np.asarray(lon)+np.asarray(lon1))/2, (np.asarray(lat)+np.asarray(lat1))/2
+
+    edge_index = {e: ind for ind, e in enumerate(edge_ids)}
+
+    # unit vectors of the midpoints, indexed per tile by a KD-tree (chord distances, see chord_of_distance_km)
+    lat_r, lon_r = np.radians(lat), np.radians(lon)
+    xyz = np.stack([np.cos(lat_r)*np.cos(lon_r), np.cos(lat_r)*np.sin(lon_r), np.sin(lat_r)], axis=1)
+
+    edge_coords = {}
+    for tile, edges in dict_tile_edges.items():
+        ind = np.array([edge_index[e] for e in edges], dtype=np.int64)
+        edge_coords[tile] = {"edges": np.array(edges, dtype=object), "lon": lon[ind], "lat": lat[ind],
+                             "xyz": xyz[ind].reshape(-1, 3), "tree": cKDTree(xyz[ind].reshape(-1, 3))}
+
+    return edge_coords
+
+
+def chord_of_distance_km(d_km):
+
+    # straight-line distance between two unit vectors whose distance_earth_km is d_km
+    return 2 * np.sin(d_km / (2 * 6371.01))
+
+
+def distance_earth_km_array(lat_o, lon_o, lat_d, lon_d):
+
+    # distance_earth_km over arrays of coordinates (degrees)
+    lat1, lat2 = np.radians(lat_o), np.radians(lat_d)
+    dlat, dlon = lat1-lat2, np.radians(lon_o)-np.radians(lon_d)
+
+    ds = 2 * np.arcsin(np.sqrt(np.sin(dlat/2.0) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin(dlon/2.0) ** 2))
+    return 6371.01 * ds
+
+
 def distance_earth_km(src, dest):
             
     lat1, lat2 = src['lat']*pi/180, dest['lat']*pi/180
@@ -452,6 +577,93 @@ def has_valid_route_traci(edge_list):
     return True
 
 
+def create_reachability_index(road_network, vclass="passenger"):
+
+    # which edges can reach which (as findRoute for vclass, following the lane connections), without SUMO:
+    # strongly connected components of the edge graph and, for each component, the bitset of the
+    # components reachable from it in the condensation DAG
+    edge_ids = [e.getID() for e in road_network.getEdges(withInternal=False) if e.allows(vclass)]
+    edge_index = {e: ind for ind, e in enumerate(edge_ids)}
+
+    src, dst = [], []
+    for e in edge_ids:
+        for e_next in road_network.getEdge(e).getAllowedOutgoing(vclass):
+            if e_next.getID() in edge_index:
+                src.append(edge_index[e])
+                dst.append(edge_index[e_next.getID()])
+
+    n = len(edge_ids)
+    graph = csr_matrix((np.ones(len(src), dtype=np.int8), (src, dst)), shape=(n, n))
+    n_components, component = connected_components(graph, directed=True, connection="strong")
+
+    # condensation DAG, visited in reverse topological order (successors first)
+    c_src, c_dst = component[np.array(src, dtype=np.int64)], component[np.array(dst, dtype=np.int64)]
+    dag_edges = np.unique(np.stack([c_src, c_dst])[:, c_src != c_dst], axis=1)
+    successors = [[] for _ in range(n_components)]
+    for c_from, c_to in dag_edges.T:
+        successors[c_from].append(c_to)
+
+    in_degree = np.bincount(dag_edges[1], minlength=n_components)
+    order = list(np.flatnonzero(in_degree == 0))
+    for c in order:
+        for c_to in successors[c]:
+            in_degree[c_to] -= 1
+            if in_degree[c_to] == 0:
+                order.append(c_to)
+
+    reach = np.zeros((n_components, (n_components+7)//8), dtype=np.uint8)
+    for c in reversed(order):
+        reach[c, c >> 3] |= np.uint8(1 << (c & 7))
+        for c_to in successors[c]:
+            reach[c] |= reach[c_to]
+
+    return {"edge_ids": np.array(edge_ids, dtype=object), "edge_index": edge_index,
+            "component": component.astype(np.int32), "reach": reach}
+
+
+def load_reachability_index(net_filename, road_network=None, vclass="passenger"):
+
+    # create_reachability_index cached in <net_filename>.reachability.npz,
+    # rebuilt when the network file changes
+    cache_filename = net_filename+".reachability.npz"
+    net_stat = os.stat(net_filename)
+    signature = np.array([net_stat.st_size, net_stat.st_mtime_ns], dtype=np.int64)
+
+    if os.path.exists(cache_filename):
+        data = np.load(cache_filename, allow_pickle=False)
+        if np.array_equal(data["signature"], signature) and str(data["vclass"]) == vclass:
+            edge_ids = data["edge_ids"].astype(object)
+            return {"edge_ids": edge_ids, "edge_index": {e: ind for ind, e in enumerate(edge_ids)},
+                    "component": data["component"], "reach": data["reach"]}
+
+    if road_network is None:
+        road_network = sumolib.net.readNet(net_filename, withInternal=False)
+
+    reachability = create_reachability_index(road_network, vclass=vclass)
+
+    np.savez(cache_filename, signature=signature, vclass=vclass, edge_ids=reachability["edge_ids"].astype(str),
+             component=reachability["component"], reach=reachability["reach"])
+
+    return reachability
+
+
+def has_valid_route_index(reachability, edge_list):
+
+    # as has_valid_route_traci, with a lookup in the reachability index
+    edge_index, component, reach = reachability["edge_index"], reachability["component"], reachability["reach"]
+
+    for i in range(len(edge_list)-1):
+        if edge_list[i] not in edge_index or edge_list[i+1] not in edge_index:
+            return False
+
+        c_from, c_to = component[edge_index[edge_list[i]]], component[edge_index[edge_list[i+1]]]
+
+        if not (reach[c_from, c_to >> 3] >> (c_to & 7)) & 1:
+            return False
+
+    return True
+
+
 def call_duarouter_command(command_str):
     
         p = subprocess.Popen(command_str, shell=True, stdout=subprocess.PIPE, 
@@ -610,12 +822,7 @@ def create_routed_demand_tomtom(dict_mobility_demand, list_id_vehicles, road_net
 def assemble_demand(demands_folder, full_demand_duarouter, full_demand_routed, n_totals, 
                        frac_routed, frac_dua, demands_output_name, prefix_nav, random_seed=None):
      
-    if random_seed is not None:
-        rand_v = random_seed
-    else:
-        rand_v = np.random.randint(0,9999999)
-
-    np.random.seed(rand_v)
+    rng = np.random.default_rng(random_seed)
 
     n_vehicles_routed = int(n_totals*frac_routed)
     n_vehicles_dua = int(n_totals*frac_dua)
@@ -625,7 +832,7 @@ def assemble_demand(demands_folder, full_demand_duarouter, full_demand_routed, n
         diff = n_totals - (n_vehicles_dua + n_vehicles_routed)
         n_vehicles_osm = n_vehicles_osm + diff
 
-    permuted_ids = list(np.random.permutation(np.arange(n_totals)))
+    permuted_ids = list(rng.permutation(np.arange(n_totals)))
 
     ids_routed = permuted_ids[:n_vehicles_routed]
     ids_dua = permuted_ids[n_vehicles_routed:]
@@ -0,0 +1,241 @@
+import os
+import sys
+import json
+import glob
+import time
+import shutil
+import platform
+import argparse
+import itertools
+import subprocess
+from datetime import datetime
+
+
+'''
+Benchmark of the simulation loop of run_sumo.py on synthetic road networks.
+It builds grid and spider networks of several sizes with netgenerate, random demands
+of several sizes with randomTrips.py, and runs run_sumo.py (one process per run) for
+every network x demand x measure flags x backend (libsumo, traci) combination.
+For each run it records the simulated steps/s (from log.json) and the peak RSS of the
+run_sumo.py process and of the processes it starts (with traci, the SUMO server), so
+that libsumo and traci runs are compared on the same scope, and writes all the results
+with the git commit to a JSON file, so that two commits can be compared run by run.
+
+e.g. python benchmark_sumo.py -o bench_results.json --sizes 5,10,20 --vehicles 500,2000
+'''
+
+
+# measure flags of run_sumo.py compared by the benchmark (co2, fuel and traveltime are on by default)
+flag_sets = {"default": [],
+             "all_emissions": ["--nox", "real", "--pmx", "real", "--co", "real", "--hc", "real", "--noise", "real"],
+             "speed": ["--speed", "real"],
+             "gps": ["--gps", "real"],
+             "v_edge_v_step": ["--v-edge", "real", "--v-step", "real"],
+             "none": ["--co2", "none", "--fuel", "none", "--traveltime", "none"]}
+
+backend_2_env = {"libsumo": "0", "traci": "1"}
+
+
+def git_commit():
+
+    script_dir = os.path.dirname(os.path.abspath(__file__))
+
+    try:
+        commit = subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=script_dir, text=True).strip()
+        dirty = len(subprocess.check_output(["git", "status", "--porcelain", "--untracked-files=no"], cwd=script_dir, text=True).strip()) > 0
+    except (OSError, subprocess.CalledProcessError):
+        commit, dirty = None, None
+
+    return commit, dirty
+
+
+def build_network(kind, size, work_dir):
+
+    # grid: size x size junctions; spider: size arms and size circles
+    net_file = f"{work_dir}/{kind}_{size}.net.xml"
+    if os.path.exists(net_file):
+        return net_file
+
+    netgenerate = os.environ["SUMO_HOME"]+"/bin/netgenerate"
+
+    if kind == "grid":
+        options = ["--grid", "--grid.number", str(size), "--grid.length", "200"]
+    else:
+        options = ["--spider", "--spider.arm-number", str(max(size, 3)), "--spider.circle-number", str(size),
+                   "--spider.space-radius", "200"]
+
+    subprocess.run([netgenerate] + options + ["--no-turnarounds", "true", "-o", net_file], check=True, capture_output=True)
+
+    return net_file
+
+
+def build_demand(net_file, n_vehicles, depart_s, seed, work_dir):
+
+    # n_vehicles routed random trips departing uniformly in [0, depart_s)
+    name = os.path.basename(net_file).replace(".net.xml", "")
+    route_file = f"{work_dir}/{name}_{n_vehicles}.rou.xml"
+    if os.path.exists(route_file):
+        return route_file
+
+    random_trips = os.environ["SUMO_HOME"]+"/tools/randomTrips.py"
+
+    subprocess.run([sys.executable, random_trips, "-n", net_file, "-o", route_file.replace(".rou.xml", ".trips.xml"),
+                    "--route-file", route_file, "-b", "0", "-e", str(depart_s), "-p", str(depart_s/n_vehicles),
+                    "--seed", str(seed), "--min-distance", "300", "--validate"], check=True, capture_output=True)
+
+    return route_file
+
+
+def count_edges(net_file):
+
+    with open(net_file) as f:
+        return sum(1 for line in f if "<edge " in line and 'function="internal"' not in line)
+
+
+def descendant_pids(pid):
+
+    # processes started (directly or not) by pid, from the parent PIDs in /proc (Linux)
+    parents = {}
+    for stat_file in glob.glob("/proc/[0-9]*/stat"):
+        try:
+            with open(stat_file) as f:
+                stat = f.read()
+        except OSError:
+            continue
+        # the fields after the command name (which may contain spaces): state, ppid, ...
+        parents.setdefault(int(stat[stat.rindex(")")+2:].split()[1]), []).append(int(stat.split()[0]))
+
+    pids, stack = [], [pid]
+    while stack:
+        children = parents.get(stack.pop(), [])
+        pids += children
+        stack += children
+
+    return pids
+
+
+def peak_rss_kb(pid):
+
+    # VmHWM: the peak resident set size of a running process
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+
+    return 0
+
+
+def run_once(net_file, route_file, flags, backend, max_hours, work_dir, poll_s=0.05):
+
+    run_dir = f"{work_dir}/runs/"
+    shutil.rmtree(run_dir, ignore_errors=True)
+    os.makedirs(run_dir)
+
+    run_sumo = os.path.join(os.path.dirname(os.path.abspath(__file__)), "run_sumo.py")
+    cmd = [sys.executable, run_sumo, "-n", net_file, "-r", route_file, "-s", run_dir, "--prefix", "run",
+           "--max-hours", str(max_hours), "--sumo-opt=--no-step-log -W"] + flags
+
+    env = dict(os.environ, TRAFFICO2_USE_TRACI=backend_2_env[backend])
+
+    start_t = time.time()
+    with open(work_dir+"/run_stderr.log", "w+b") as f_err:
+        proc = subprocess.Popen(cmd, env=env, stdout=subprocess.DEVNULL, stderr=f_err, cwd=os.path.dirname(run_sumo))
+
+        # peak RSS of the processes started by run_sumo.py (the SUMO server with traci), polled until it exits
+        children_peak_kb = {}
+        while True:
+            pid, status, rusage = os.wait4(proc.pid, os.WNOHANG)
+            if pid != 0:
+                break
+            for child in descendant_pids(proc.pid):
+                children_peak_kb[child] = max(children_peak_kb.get(child, 0), peak_rss_kb(child))
+            time.sleep(poll_s)
+
+        f_err.seek(0)
+        stderr = f_err.read()
+
+    # resource usage of the run_sumo.py process (ru_maxrss is in KB on Linux)
+    proc.returncode = os.waitstatus_to_exitcode(status)
+    wall = time.time() - start_t
+
+    log_files = glob.glob(run_dir+"run_*/log.json")
+    if proc.returncode != 0 or len(log_files) == 0:
+        raise RuntimeError(f"run_sumo.py failed ({proc.returncode}): {stderr.decode(errors='replace')[-2000:]}")
+
+    with open(log_files[0]) as f:
+        dict_log = json.load(f)
+
+    shutil.rmtree(run_dir)
+
+    return {"n_steps": dict_log["n_steps"],
+            "n_vehicles": dict_log["n_vehicles"],
+            "execution_time_s": dict_log["execution_time_s"],
+            "steps_per_s": round(dict_log["n_steps"]/max(dict_log["execution_time_s"], 1e-6), 2),
+            "peak_rss_mb": round((rusage.ru_maxrss + sum(children_peak_kb.values()))/1024, 1),
+            "peak_rss_python_mb": round(rusage.ru_maxrss/1024, 1),
+            "peak_rss_sumo_server_mb": round(sum(children_peak_kb.values())/1024, 1),
+            "rss_scope": "run_sumo.py with libsumo" if backend == "libsumo" else "run_sumo.py + SUMO server",
+            "wall_time_s": round(wall, 2),
+            "sumo_version": dict_log["sumo_version"]}
+
+
+def main():
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-o", "--output", type=str, required=True, help="JSON file of the results.")
+    parser.add_argument("--work-dir", type=str, default="./benchmark_data", help="Directory of the generated networks, demands and run outputs.")
+    parser.add_argument("--networks", type=str, default="grid,spider", help="Comma-separated network kinds (grid, spider).")
+    parser.add_argument("--sizes", type=str, default="5,10,20", help="Comma-separated network sizes (junctions per side for grid, arms/circles for spider).")
+    parser.add_argument("--vehicles", type=str, default="200,1000", help="Comma-separated numbers of vehicles of the random demands.")
+    parser.add_argument("--flags", type=str, default=",".join(flag_sets), help="Comma-separated measure flag sets among: "+", ".join(flag_sets)+".")
+    parser.add_argument("--backends", type=str, default="libsumo,traci", help="Comma-separated backends (libsumo, traci).")
+    parser.add_argument("--depart-s", type=int, default=600, help="Departures are spread over the first N seconds.")
+    parser.add_argument("--max-hours", type=float, default=1, help="The maximum number of hours to simulate in each run.")
+    parser.add_argument("--repeat", type=int, default=1, help="Number of runs of each combination.")
+    parser.add_argument("--seed", type=int, default=42, help="Seed of the random demands.")
+    args = parser.parse_args()
+
+    if 'SUMO_HOME' not in os.environ:
+        sys.exit("please declare environment variable 'SUMO_HOME'")
+
+    work_dir = os.path.abspath(args.work_dir)
+    os.makedirs(work_dir, exist_ok=True)
+
+    commit, dirty = git_commit()
+
+    dict_bench = {"commit": commit, "dirty": dirty, "date": datetime.now().isoformat(timespec="seconds"),
+                  "python": platform.python_version(), "platform": platform.platform(),
+                  "cpu_count": os.cpu_count(), "args": vars(args), "results": []}
+
+    combinations = itertools.product(args.networks.split(","), [int(s) for s in args.sizes.split(",")],
+                                     [int(v) for v in args.vehicles.split(",")], args.flags.split(","),
+                                     args.backends.split(","), range(args.repeat))
+
+    for kind, size, n_vehicles, flag_name, backend, rep in combinations:
+
+        net_file = build_network(kind, size, work_dir)
+        route_file = build_demand(net_file, n_vehicles, args.depart_s, args.seed, work_dir)
+
+        result = {"network": kind, "size": size, "n_edges": count_edges(net_file), "vehicles": n_vehicles,
+                  "flags": flag_name, "backend": backend, "repeat": rep}
+
+        try:
+            result.update(run_once(net_file, route_file, flag_sets[flag_name], backend, args.max_hours, work_dir))
+        except RuntimeError as e:
+            result["error"] = str(e)
+
+        dict_bench["results"].append(result)
+
+        print(f"{kind} {size} ({result['n_edges']} edges), {n_vehicles} vehicles, {flag_name}, {backend}: "
+              + (f"{result['steps_per_s']} steps/s, {result['peak_rss_mb']} MB" if "error" not in result else "FAILED"))
+
+        # written after every run, so a partial benchmark is not lost
+        with open(args.output, "w") as f:
+            json.dump(dict_bench, f, indent=1)
+
+
+if __name__ == "__main__":
+    main()
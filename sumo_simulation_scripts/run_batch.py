@@ -0,0 +1,125 @@
+import os
+import time
+import argparse
+import contextlib
+import traceback
+from glob import glob
+from multiprocessing import get_context
+from sim_utils_sumo import init_arguments
+
+
+'''
+Runs one simulation per route file matching a glob pattern (e.g., the outputs of
+create_mixed_routed_paths) over a bounded pool of worker processes.
+Each run is executed in a fresh process (and so with its own libsumo instance) or,
+with --reuse-sumo 1, each worker starts SUMO once and loads the next route file into
+it with traci.load. Every run writes its outputs to save_dir/<prefix>_<route file name>;
+runs whose log.json already exists are skipped, so an interrupted sweep can be
+relaunched as is.
+
+e.g. python run_batch.py -n net.net.xml -r "../sumo_simulation_data/routed_paths/mixed_paths_osm/*.rou.xml" -s ../sim_outputs/osm/ -w 8
+'''
+
+
+def scenario_save_dir(save_dir, prefix, route_file):
+
+    name = os.path.basename(route_file).replace(".rou.xml", "")
+    if len(prefix) > 0:
+        name = prefix+"_"+name
+
+    return os.path.join(save_dir, name)
+
+
+# with --reuse-sumo 1, whether the SUMO instance of this worker process is running
+sumo_started = False
+
+
+def run_scenario(task):
+
+    global sumo_started
+
+    args, save_dir = task
+    reuse = args.reuse_sumo == 1
+
+    # imported in the worker so that each process owns its libsumo instance
+    import run_sumo
+
+    os.makedirs(save_dir, exist_ok=True)
+
+    try:
+        with open(save_dir+"/run.log", "w") as f_log, contextlib.redirect_stdout(f_log):
+            dict_log = run_sumo.run_simulation(args, save_dir=save_dir, reload=reuse and sumo_started, close=not reuse)
+        sumo_started = reuse
+        return args.route_file, dict_log, None
+    except Exception:
+        # the next route file of this worker starts a clean SUMO instance
+        if sumo_started:
+            with contextlib.suppress(Exception):
+                run_sumo.traci.close()
+            sumo_started = False
+        return args.route_file, None, traceback.format_exc()
+
+
+def main():
+
+    parser = argparse.ArgumentParser()
+    init_arguments(parser, batch=True)
+    args = parser.parse_args()
+
+    route_files = sorted(glob(args.routes))
+
+    tasks, n_skipped = [], 0
+
+    for route_file in route_files:
+
+        save_dir = scenario_save_dir(args.save_dir, args.prefix, route_file)
+
+        if os.path.exists(save_dir+"/log.json"):
+            n_skipped += 1
+            continue
+
+        args_run = argparse.Namespace(**vars(args))
+        args_run.route_file = route_file
+        args_run.resume = ""
+        tasks.append((args_run, save_dir))
+
+    print(f"Route files: {len(route_files)}, to simulate: {len(tasks)}, skipped (already done): {n_skipped}")
+    print(f"Workers: {args.workers}\n")
+
+    start_t = time.time()
+    n_done, n_failed, total_steps, total_vehicles = 0, 0, 0, 0
+
+    # spawn + one task per child: every run gets a clean process and SUMO instance,
+    # unless the workers reuse their SUMO instance across the route files
+    ctx = get_context("spawn")
+    maxtasksperchild = None if args.reuse_sumo == 1 else 1
+
+    with ctx.Pool(processes=max(1, min(args.workers, len(tasks))), maxtasksperchild=maxtasksperchild) as pool:
+
+        for route_file, dict_log, error in pool.imap_unordered(run_scenario, tasks):
+
+            if error is not None:
+                n_failed += 1
+                print(f"FAILED {route_file}\n{error}")
+                continue
+
+            n_done += 1
+            total_steps += dict_log["n_steps"]
+            total_vehicles += dict_log["n_vehicles"]
+
+            print(f"[{n_done+n_failed}/{len(tasks)}] {route_file}: {dict_log['n_steps']} steps in {dict_log['execution_time_s']} s")
+
+    elapsed = time.time() - start_t
+
+    print("END OF THE BATCH **********************")
+    print("Completed runs: "+str(n_done)+", failed: "+str(n_failed)+", skipped: "+str(n_skipped))
+    print("Wall time (s): "+str(round(elapsed, 2)))
+
+    if elapsed > 0 and n_done > 0:
+        print("Throughput: "+str(round(n_done/elapsed*3600, 2))+" runs/h, "
+              +str(round(total_steps/elapsed, 2))+" simulated steps/s, "
+              +str(round(total_vehicles/elapsed, 2))+" vehicles/s")
+
+
+if __name__ == "__main__":
+    main()
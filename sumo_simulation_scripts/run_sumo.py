@@ -2,18 +2,21 @@ import os
 import sys
 import time
 import json
+import shutil
 import pandas as pd
 import numpy as np
 from sys import argv
 from itertools import groupby
 from xml.dom import minidom
 from sim_utils_sumo import *
-from multiprocessing import Process
 import argparse
 
 
 # conditional import, libsumo (if available) should be preferred as it is faster than traci
+# (TRAFFICO2_USE_TRACI=1 forces traci, e.g. to benchmark the two backends)
 try:
+    if os.environ.get("TRAFFICO2_USE_TRACI", "0") == "1":
+        raise ImportError
     import libsumo as traci
 except ImportError:
     import traci
@@ -23,127 +26,167 @@ import traci.constants as tc
 print(traci)
 
 
-# create the parser
-parser = argparse.ArgumentParser()
-init_arguments(parser)
-args = parser.parse_args()
-print(args)
+def run_simulation(args, save_dir=None, reload=False, close=True):
 
-print("TraffiCO2 version 2.1")
+    print("TraffiCO2 version 2.1")
 
-# simulation parameters
-net_filename = args.net_file
-route_filename = args.route_file
-use_gui = True if int(args.gui) == 1 else False
-opt_options = [] if len(args.sumo_opt) == 0 else args.sumo_opt.split(" ")
+    # resume an interrupted run with its own arguments and output directory
+    ckpt_dir = None
+    if len(args.resume) > 0:
+        ckpt_dir, dict_ckpt = latest_checkpoint(args.resume)
+        args = argparse.Namespace(**dict(dict_ckpt["args"], resume=args.resume))
+        save_dir = args.resume
 
+    # simulation parameters
+    net_filename = args.net_file
+    route_filename = args.route_file
+    use_gui = True if int(args.gui) == 1 else False
+    opt_options = [] if len(args.sumo_opt) == 0 else args.sumo_opt.split(" ")
 
-# save parameters
-save_dir = args.save_dir
-folder_prefix = args.prefix
-create_log = True
+    if args.checkpoint_every > 0:
+        opt_options += checkpoint_sumo_options
 
-#create simulation ID %d_%m_%H_%M_%S
-sim_id = create_sim_id()
 
-#create directory for output
-save_dir=save_dir+folder_prefix+"_"+sim_id+"_"+str(np.random.randint(0, 1e9))
-os.mkdir(save_dir)
+    # save parameters
+    folder_prefix = args.prefix
+    create_log = True
 
+    #create simulation ID %d_%m_%H_%M_%S
+    sim_id = create_sim_id() if ckpt_dir is None else dict_ckpt["sim_id"]
 
-# max steps in secs
-max_steps = args.max_hours*60*60
+    #create directory for output (unless the caller, e.g. run_batch.py, chooses it)
+    if save_dir is None:
+        save_dir = args.save_dir+folder_prefix+"_"+sim_id+"_"+str(np.random.randint(0, 1e9))
+    os.makedirs(save_dir, exist_ok=True)
 
-# save v_edge every "sampling_freq" steps
-sampling_freq = 5*60 # 5 minutes
 
-#net_filename, route_filename = return_net_and_route_filenames(config_filename)
-total_vehicles = return_number_vehicles(route_filename)
+    # max steps in secs
+    max_steps = args.max_hours*60*60
 
-#configuration the simulation
-def_options, opt_options, sumo_version = config_start_sumo(net_filename, route_filename, opt_options=opt_options, use_gui=use_gui)
-print_starting_config(sim_id, use_gui, net_filename, route_filename, opt_options, total_vehicles, sumo_version, save_dir, max_steps)
+    #net_filename, route_filename = return_net_and_route_filenames(config_filename)
+    # single streaming scan for the number of vehicles, their IDs and departure range
+    route_info = scan_route_file(route_filename)
+    total_vehicles = route_info["n_vehicles"] + route_info["n_flow_vehicles"]
 
+    # flows with a random number of vehicles: the simulation runs until SUMO expects no more vehicles
+    open_flows = route_info["n_open_flows"] > 0
+    if open_flows:
+        print(f"Warning: {route_info['n_open_flows']} flows with a random or unbounded number of vehicles, "
+              "the simulation runs until no vehicle is expected")
 
-#compute edge and vehicle list
-edge_list = filter_edges_for_route(internal=True)
-vehicle_id_list = return_vehicles_id(route_filename)
+    #configuration the simulation
+    def_options, opt_options, sumo_version = config_start_sumo(net_filename, route_filename, opt_options=opt_options, use_gui=use_gui, reload=reload)
+    print_starting_config(sim_id, use_gui, net_filename, route_filename, opt_options, total_vehicles, sumo_version, save_dir, max_steps)
 
-# measures to collect
-collect_measures = prepare_dict_measures(args, save_dir, edge_list, vehicle_id_list)
 
-print_recap_measures(collect_measures)
+    #compute edge and vehicle list
+    edge_list = filter_edges_for_route(internal=True)
+    vehicle_id_list = route_info["vehicle_ids"]
 
+    # timing of the phases of the simulation loop (no-op unless --profile 1)
+    profiler = StepProfiler(enabled=args.profile == 1, per_step=args.profile_steps == 1)
 
-# simulation variables
-n_teleports, step, vehicles_arrived = 0, 0, 0
+    # simulation variables
+    n_teleports, step, vehicles_arrived, elapsed_before = 0, 0, 0, 0
 
+    if ckpt_dir is None:
 
-# start time
-start_t = time.time()
+        # GPS traces are streamed to disk during the simulation
+        gps_writer = None
+        if args.gps != "none":
+            gps_writer = TraceWriter(f"{save_dir}/gps_vehicle.{args.gps_format}", file_format=args.gps_format,
+                                     flush_steps=args.gps_flush_steps, flush_rows=args.gps_flush_rows,
+                                     projection=GeoProjection(**read_net_location(net_filename)))
 
+        # measures to collect
+        collect_measures = MeasureStore(args, edge_list, vehicle_id_list, v_edge_interval=args.v_edge_interval, 
+                                        gps_writer=gps_writer, profiler=profiler)
 
-tmp = {}
+        # emissions per edge per time window, memory-mapped to disk
+        if args.emission_window > 0 and len(collect_measures.emissions) > 0:
+            collect_measures.emission_windows = EdgeEmissionWindows(save_dir+"/edge_emissions_windowed", edge_list, collect_measures.emissions,
+                                                                    args.emission_window, max_steps)
 
+        # vehicles (and the enabled emissions) per tile, aggregated during the simulation
+        if len(args.tile_map) > 0:
+            collect_measures.tiles = TileAggregator(load_tile_map(args.tile_map), edge_list, collect_measures.emissions, args.tile_window)
 
-while vehicles_arrived < total_vehicles and step < max_steps:
-    
+    else:
+        # the output files of the interrupted run are reopened, not recreated
+        collect_measures = restore_checkpoint(ckpt_dir, dict_ckpt)
+        collect_measures.profiler = profiler
+        n_teleports, step, vehicles_arrived = dict_ckpt["n_teleports"], dict_ckpt["step"], dict_ckpt["vehicles_arrived"]
+        elapsed_before = dict_ckpt["elapsed"]
 
-    vehicles_step = 0
+    # outputs written during the simulation (GPS, emission windows) go through a background writer thread
+    writer = AsyncWriter(max_pending=args.writer_queue) if args.writer_queue > 0 else None
+    collect_measures.attach_writer(writer)
 
-    traci.simulationStep()
-    vehicle_list = traci.vehicle.getIDList()
+    print_recap_measures(collect_measures)
 
-    # Subscriptions (only once when the vehicle enters the simulation)
-    for veh_id in traci.simulation.getDepartedIDList():
-        traci.vehicle.subscribe(veh_id, [tc.VAR_ROAD_ID, tc.VAR_CO2EMISSION, tc.VAR_POSITION, tc.VAR_SPEED, tc.VAR_NOXEMISSION, tc.VAR_FUELCONSUMPTION, tc.VAR_PMXEMISSION, tc.VAR_NOISEEMISSION, tc.VAR_HCEMISSION, tc.VAR_COEMISSION])
 
+    # start time
+    start_t = time.time()
+
+
+    while (vehicles_arrived < total_vehicles if not open_flows else traci.simulation.getMinExpectedNumber() > 0) and step < max_steps:
+
+
+        profiler.start_step()
+
+        traci.simulationStep()
+        profiler.lap("simulation_step")
+
+        # Subscriptions (only once when the vehicle enters the simulation)
+        departed_list = traci.simulation.getDepartedIDList()
+
+        for veh_id in departed_list:
+            traci.vehicle.subscribe(veh_id, subscription_variables)
+
+        # cache the cohort of the departed vehicles
+        collect_measures.add_departed(departed_list, step)
+        profiler.lap("subscriptions")
 
-    for vehicle in vehicle_list:
 
         # get the results from the Subscription
-        res_sub = traci.vehicle.getSubscriptionResults(vehicle)
-        
+        results_sub = retrieve_subscription_results(args.subscription_mode)
+        profiler.lap("subscription_retrieval")
+
         # update the data structure that collects the measures
-        update_measures(vehicle, res_sub, collect_measures)
-        
-        # Vehicles per timestap
-        if is_measure_to_collect(collect_measures, "v_step") and is_to_collect(vehicle, collect_measures["v_step"]["mode"]):
-            vehicles_step += 1
-    
-        if is_measure_to_collect(collect_measures, "v_edge") and step%sampling_freq==0:
-            edge_id = res_sub[tc.VAR_ROAD_ID]
-            collect_measures["v_edge"]["values"]["edge"][edge_id][-1]+=1
-            
-    
-    if is_measure_to_collect(collect_measures, "v_edge") and step%sampling_freq==0:    
-        for k in collect_measures["v_edge"]["values"]["edge"]:
-            collect_measures["v_edge"]["values"]["edge"][k].append(0)
-    
+        collect_measures.update(step, results_sub)
+        profiler.lap("update_measures")
 
-    if is_measure_to_collect(collect_measures, "v_step"):
-        collect_measures["v_step"]["values"]["vehicle"].append(vehicles_step)
+        # collect number of teleported vehicles
+        n_teleports += traci.simulation.getStartingTeleportNumber()
 
-    # collect number of teleported vehicles
-    n_teleports += traci.simulation.getStartingTeleportNumber()
+        # vehicles that left the network in this step
+        arrived_list = traci.simulation.getArrivedIDList()
+        collect_measures.add_arrived(arrived_list, step)
 
-    step += 1
-    vehicles_arrived += traci.simulation.getArrivedNumber()
+        step += 1
+        vehicles_arrived += len(arrived_list)
+        profiler.lap("simulation_counters")
 
+        if args.checkpoint_every > 0 and step % args.checkpoint_every == 0:
+            save_checkpoint(save_dir, collect_measures, {"step": step, "n_teleports": n_teleports, "vehicles_arrived": vehicles_arrived,
+                                                         "elapsed": elapsed_before + time.time() - start_t, "sim_id": sim_id, "args": vars(args)})
+            profiler.lap("checkpoint")
 
+        profiler.end_step(step-1, len(results_sub))
 
-elapsed = time.time() - start_t
-print("END OF THE SIMULATION **********************")
-print("Execution time (s): "+str(round(elapsed, 2)))
-print("Number of teleports: "+str(n_teleports))
 
 
-# Save measures
-save_measures(collect_measures, edge_list, vehicle_id_list, save_dir)
+    # with open flows, the vehicles inserted during the simulation
+    if open_flows:
+        total_vehicles = vehicles_arrived + traci.vehicle.getIDCount()
 
+    elapsed = elapsed_before + time.time() - start_t
+    print("END OF THE SIMULATION **********************")
+    print("Execution time (s): "+str(round(elapsed, 2)))
+    print("Number of teleports: "+str(n_teleports))
 
-# Create log file
-if create_log:
+
+    # Create log file
     dict_log = {}
     dict_log["id"] = sim_id
     dict_log["sumo_version"] = sumo_version
@@ -153,17 +196,16 @@ if create_log:
     dict_log["opt_options"] = opt_options
     dict_log["execution_time_s"] = round(elapsed, 2)
     dict_log["n_vehicles"] = total_vehicles
+    dict_log["n_open_flows"] = route_info["n_open_flows"]
+    dict_log["depart_range"] = [route_info["depart_min"], route_info["depart_max"]]
     dict_log["n_teleports"] = n_teleports
     dict_log["n_steps"] = step
     dict_log["max_steps"] = max_steps
-    
-    
-    total_co2_out = 0
-    
-    for edge_id in edge_list:
-        total_co2_out+=collect_measures["co2"]["values"]["edge"][edge_id]
-    
-    
+
+
+    total_co2_out = float(collect_measures.edge_totals("co2").sum())
+
+
     print("******************************************")
     print("******************************************")
     print("******************************************")
@@ -171,13 +213,51 @@ if create_log:
     print("******************************************")
     print("******************************************")
     print("******************************************")
-    
-    
+
+
     dict_log["total_co2"] = total_co2_out
 
-    a_file = open(save_dir+"/log.json", "w")
-    json.dump(dict_log, a_file)
-    a_file.close()
 
-#close traci
-traci.close()
\ No newline at end of file
+    # Save measures (parquet files embed the log)
+    profiler.start_step()
+    save_measures(collect_measures, save_dir, output_format=args.output_format, metadata=dict_log)
+    if writer is not None:
+        writer.close()
+    profiler.lap("save_measures")
+
+    if args.profile == 1:
+        dict_log["profile"] = profiler.summary()
+        if args.profile_steps == 1:
+            profiler.save_steps(save_dir+"/profile_steps.csv")
+
+    if create_log:
+        a_file = open(save_dir+"/log.json", "w")
+        json.dump(dict_log, a_file)
+        a_file.close()
+
+    # the run is complete, the checkpoints are no longer needed
+    if os.path.exists(save_dir+"/checkpoints"):
+        shutil.rmtree(save_dir+"/checkpoints")
+
+    #close traci (unless the instance is reused for the next route file)
+    if close:
+        traci.close()
+
+    return dict_log
+
+
+
+if __name__ == "__main__":
+
+    # create the parser
+    parser = argparse.ArgumentParser()
+    init_arguments(parser)
+    args = parser.parse_args()
+
+    # a resumed run takes the files and the output directory from its checkpoint
+    if len(args.resume) == 0 and None in (args.net_file, args.route_file, args.save_dir):
+        parser.error("the following arguments are required: -n/--net-file, -r/--route-file, -s/--save-dir (unless --resume)")
+
+    print(args)
+
+    run_simulation(args)
@@ -3,15 +3,26 @@ import random
 import os
 import sys
 import xml
+from xml.etree import ElementTree
 import pandas as pd
 from datetime import datetime
 import argparse
+import time
+import json
+import pickle
+import shutil
+import queue
+import threading
+import zlib
 import sumolib
 import numpy as np
 
 
 # conditional import, libsumo (if available) should be preferred as it is faster than traci
+# (TRAFFICO2_USE_TRACI=1 forces traci, e.g. to benchmark the two backends)
 try:
+    if os.environ.get("TRAFFICO2_USE_TRACI", "0") == "1":
+        raise ImportError
     import libsumo as traci
 except ImportError:
     import traci
@@ -19,139 +30,882 @@ except ImportError:
 import traci.constants as tc
 
 
-def prepare_dict_measures(args, save_dir, edge_list, vehicle_id_list):
-    
-    
-    measure_2_details = {"gps":["vehicle"], 
-                        "co2":["edge", "vehicle"],
-                        "nox":["edge", "vehicle"],
-                        "pmx":["edge", "vehicle"],
-                        "noise":["edge", "vehicle"],
-                         "hc":["edge", "vehicle"],
-                         "co":["edge", "vehicle"],
-                        "fuel":["edge", "vehicle"], 
-                        "speed":["edge"], 
-                        "traveltime":["vehicle"], 
-                        "v_edge":["edge"], 
-                        "v_step":["vehicle"]}
-    
-    collect_measures = {}
-    
-    # init the dict
-    for measure in measure_2_details:
-        
-        collect_measures[measure] = {"mode": getattr(args, measure),#args[measure], 
-                                     #"filenames": {k: f"{save_dir}/{measure}_{k}.csv" for k in measure_2_details[measure]},
-                                     "values": {k: {} for k in measure_2_details[measure]}}
-        
-        
-    # prepare the initial values 
-    for measure in measure_2_details:
-        
-        if measure=="gps": 
-            collect_measures["gps"]["values"]["uids"] = []
-            collect_measures["gps"]["values"]["lats"] = []
-            collect_measures["gps"]["values"]["lngs"] = []
-            collect_measures["gps"]["values"]["timestamps"] = []
-            
-        elif measure in ["co2", "nox", "fuel", "hc", "co", "noise", "pmx"]:
-            
-            for edge in edge_list:
-                collect_measures[measure]["values"]["edge"][edge] = 0
-            for v_id in vehicle_id_list:
-                collect_measures[measure]["values"]["vehicle"][v_id] = 0
-                
-        elif measure=="speed":
-            for edge in edge_list:
-                collect_measures[measure]["values"]["edge"][edge] = []
-        
-        elif measure=="traveltime":
-            for v_id in vehicle_id_list:
-                collect_measures[measure]["values"]["vehicle"][v_id] = 0 
-                
-        # Timeseries       
-        elif measure=="v_edge":
-            for edge in edge_list:
-                collect_measures[measure]["values"]["edge"][edge] = [0]
-                
-        elif measure=="v_step":
-            for v_id in vehicle_id_list:
-                collect_measures[measure]["values"]["vehicle"] = []
-        
-    return collect_measures
+# measures collected at edge and/or vehicle level
+measure_2_details = {"gps":["vehicle"], 
+                    "co2":["edge", "vehicle"],
+                    "nox":["edge", "vehicle"],
+                    "pmx":["edge", "vehicle"],
+                    "noise":["edge", "vehicle"],
+                     "hc":["edge", "vehicle"],
+                     "co":["edge", "vehicle"],
+                    "fuel":["edge", "vehicle"], 
+                    "speed":["edge"], 
+                    "traveltime":["vehicle"], 
+                    "v_edge":["edge"], 
+                    "v_step":["vehicle"]}
+
+# emission measures and the subscription variable that provides them
+emission_2_variable = {"co2": tc.VAR_CO2EMISSION,
+                       "nox": tc.VAR_NOXEMISSION,
+                       "fuel": tc.VAR_FUELCONSUMPTION,
+                       "pmx": tc.VAR_PMXEMISSION,
+                       "noise": tc.VAR_NOISEEMISSION,
+                       "co": tc.VAR_COEMISSION,
+                       "hc": tc.VAR_HCEMISSION}
+
+
+# variables subscribed for each vehicle when it enters the simulation
+subscription_variables = [tc.VAR_ROAD_ID, tc.VAR_CO2EMISSION, tc.VAR_POSITION, tc.VAR_SPEED, tc.VAR_NOXEMISSION, 
+                          tc.VAR_FUELCONSUMPTION, tc.VAR_PMXEMISSION, tc.VAR_NOISEEMISSION, tc.VAR_HCEMISSION, tc.VAR_COEMISSION]
+
+# cohorts of vehicles: 0 for the real vehicles, 1 for the background ones ("rand")
+cohort_real, cohort_rand = 0, 1
+
+# cohorts collected by each collection mode
+collect_mode_2_cohorts = {"all": [True, True],
+                          "real": [True, False],
+                          "rand": [False, True],
+                          "none": [False, False]}
+
+# measures that accept a sampled collection mode (see parse_collect_mode)
+sampled_measures = ["gps", "speed"]
+
+
+class AsyncWriter:
+    '''
+    Background thread that serializes the chunks of the outputs written during the
+    simulation (GPS rows, windows of the edge emissions), so that the simulation loop
+    only hands them over. The queue is bounded: when max_pending chunks are waiting
+    submit blocks until the thread catches up. An error of the thread is raised by the
+    next submit or flush.
+    '''
 
+    def __init__(self, max_pending=8):
 
+        self.queue = queue.Queue(maxsize=max_pending)
+        self.error = None
 
-def update_measures(vehicle, result_sub, collect_measures):
-    
-    # collect measures
-    edge_id = result_sub[tc.VAR_ROAD_ID]
-    x, y = result_sub[tc.VAR_POSITION]
-    speed = result_sub[tc.VAR_SPEED]
-    
-    co2_emissions = result_sub[tc.VAR_CO2EMISSION]
-    nox_emissions = result_sub[tc.VAR_NOXEMISSION]
-    fuel_emissions = result_sub[tc.VAR_FUELCONSUMPTION]
-    pmx_emissions = result_sub[tc.VAR_PMXEMISSION]
-    hc_emissions = result_sub[tc.VAR_HCEMISSION]
-    co_emissions = result_sub[tc.VAR_COEMISSION]
-    noise_emissions = result_sub[tc.VAR_NOISEEMISSION]
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
 
-    
-    # updates the data structures
-    
-    # GPS
-    if is_measure_to_collect(collect_measures, "gps") and is_to_collect(vehicle, collect_measures["gps"]["mode"]):
-
-        lon, lat = traci.simulation.convertGeo(x, y)
-        collect_measures["gps"]["values"]["uids"].append(vehicle)
-        collect_measures["gps"]["values"]["lats"].append(lat)
-        collect_measures["gps"]["values"]["lngs"].append(lon)
-        collect_measures["gps"]["values"]["timestamps"].append(step)
-        
-    measures_edge_and_vehicle_level = ["co2", "nox", "fuel", "pmx", "noise", "co", "hc"]
 
-    for m_ev in measures_edge_and_vehicle_level:
-        
-        if is_measure_to_collect(collect_measures, m_ev) and is_to_collect(vehicle, collect_measures[m_ev]["mode"]):
-            
-            m_ev_value = eval(m_ev+"_emissions")
-                
-            collect_measures[m_ev]["values"]["edge"][edge_id] += m_ev_value
-            #collect_measures[m_ev]["values"]["vehicle"][vehicle] += m_ev_value
-              
-        
-    # Speed
-    if is_measure_to_collect(collect_measures, "speed") and is_to_collect(vehicle, collect_measures["speed"]["mode"]):
-        collect_measures["speed"]["values"]["edge"][edge_id].append(speed)
-        
-    
-    # Traveltime
-    if is_measure_to_collect(collect_measures, "traveltime") and is_to_collect(vehicle, collect_measures["traveltime"]["mode"]):
-         collect_measures["traveltime"]["values"]["vehicle"][vehicle]+=1
-    
-    
-    # Vehicles per edge (OLD but GOLD version)
-   
-    '''if is_measure_to_collect(collect_measures, "v_edge") and is_to_collect(vehicle, collect_measures["v_edge"]["mode"]):
-        if len(collect_measures["v_edge"]["values"]["vehicle"][vehicle])>0:
-            if collect_measures["v_edge"]["values"]["vehicle"][vehicle][-1]!=edge_id:
-                collect_measures["v_edge"]["values"]["vehicle"][vehicle].append(edge_id)
+    def run(self):
+
+        while True:
+            task = self.queue.get()
+
+            if task is None:
+                self.queue.task_done()
+                return
+
+            func, args = task
+            try:
+                if self.error is None:
+                    func(*args)
+            except Exception as e:
+                self.error = e
+            finally:
+                self.queue.task_done()
+
+
+    def check(self):
+
+        if self.error is not None:
+            raise RuntimeError("error while writing the simulation outputs") from self.error
+
+
+    def submit(self, func, *args):
+
+        self.check()
+        self.queue.put((func, args))
+
+
+    def flush(self):
+
+        # wait for the chunks submitted so far
+        self.queue.join()
+        self.check()
+
+
+    def close(self):
+
+        self.flush()
+        self.queue.put(None)
+        self.thread.join()
+
+
+
+class GeoProjection:
+    '''
+    Vectorized conversion of the network x/y to lon/lat, as traci.simulation.convertGeo
+    and sumolib's convertXY2LonLat: the netOffset is removed and the inverse of the
+    projParameter projection is applied (pyproj). Networks without a projection ("!")
+    keep x/y, as convertGeo does.
+    '''
+
+    def __init__(self, net_offset=(0.0, 0.0), proj_parameter="!"):
+
+        self.net_offset = net_offset
+        self.proj_parameter = proj_parameter
+        self.proj = None
+
+
+    def to_lonlat(self, x, y):
+
+        x, y = np.asarray(x, dtype=np.float64), np.asarray(y, dtype=np.float64)
+
+        if self.proj_parameter == "!":
+            return x, y
+
+        if self.proj is None:
+            import pyproj
+            self.proj = pyproj.Proj(projparams=self.proj_parameter)
+
+        return self.proj(x - self.net_offset[0], y - self.net_offset[1], inverse=True)
+
+
+    def __getstate__(self):
+
+        state = dict(self.__dict__)
+        state["proj"] = None
+        return state
+
+
+
+class TraceWriter:
+    '''
+    Streams the GPS traces to disk in chunks, keeping in memory at most the rows
+    collected since the last flush (every flush_steps steps or flush_rows rows).
+    The rows are kept as network x/y (float32) and converted to lon/lat with the
+    GeoProjection of the network when the chunk is written.
+
+    Output layout: one row per vehicle per collected step with the columns
+        uid (str), lat (float64), lng (float64), timestamp (int64, simulation second)
+    sorted by timestamp, written as
+        csv: a single file gps_vehicle.csv
+        parquet: a directory gps_vehicle.parquet/ of part-00000.parquet, part-00001.parquet, ...
+                 files (one per chunk), read as a single table by pd.read_parquet
+    It can be read back as a skmob TrajDataFrame with
+        skmob.TrajDataFrame(pd.read_csv(filename), latitude="lat", longitude="lng",
+                            datetime="timestamp", user_id="uid", timestamp=True)
+    (pd.read_parquet for the parquet format), where the simulation seconds become
+    datetimes starting from 1970-01-01 00:00:00.
+    '''
+
+    columns = ["uid", "lat", "lng", "timestamp"]
+    chunk_columns = ["uid", "x", "y", "timestamp"]
+
+    def __init__(self, filename, file_format="csv", flush_steps=300, flush_rows=500000, writer=None, projection=None):
+
+        self.filename = filename
+        self.writer = writer
+        self.projection = projection if projection is not None else GeoProjection()
+        self.file_format = file_format
+        self.flush_steps = flush_steps
+        self.flush_rows = flush_rows
+
+        self.chunk = {c: [] for c in self.chunk_columns}
+        self.n_rows_chunk, self.n_rows = 0, 0
+        self.last_flush_step = 0
+
+        self.n_parts = 0
+        self.header = True
+
+        if self.file_format == "parquet":
+            os.makedirs(self.filename, exist_ok=True)
+
+
+    def add(self, step, uids, xs, ys):
+
+        self.chunk["uid"].append(np.asarray(uids, dtype=object))
+        self.chunk["x"].append(np.asarray(xs, dtype=np.float32))
+        self.chunk["y"].append(np.asarray(ys, dtype=np.float32))
+        self.chunk["timestamp"].append(np.full(len(uids), step, dtype=np.int64))
+
+        self.n_rows_chunk += len(uids)
+
+        if self.n_rows_chunk >= self.flush_rows or step - self.last_flush_step >= self.flush_steps:
+            self.flush(step)
+
+
+    def flush(self, step=None):
+
+        if step is not None:
+            self.last_flush_step = step
+
+        if self.n_rows_chunk == 0:
+            return
+
+        # the DataFrame is built and written by the background writer, if any
+        if self.writer is not None:
+            self.writer.submit(self.write_rows, self.chunk)
+        else:
+            self.write_rows(self.chunk)
+
+        self.n_rows += self.n_rows_chunk
+        self.n_rows_chunk = 0
+        self.chunk = {c: [] for c in self.chunk_columns}
+
+
+    def write_rows(self, chunk):
+
+        # one vectorized projection per chunk
+        lng, lat = self.projection.to_lonlat(np.concatenate(chunk["x"]), np.concatenate(chunk["y"]))
+
+        self.write_chunk(pd.DataFrame({"uid": np.concatenate(chunk["uid"]), "lat": lat, "lng": lng,
+                                       "timestamp": np.concatenate(chunk["timestamp"])}))
+
+
+    def write_chunk(self, d_chunk):
+
+        if self.file_format == "parquet":
+            # requires pyarrow (or fastparquet)
+            d_chunk.to_parquet(f"{self.filename}/part-{self.n_parts:05d}.parquet", index=False)
+            self.n_parts += 1
+        else:
+            d_chunk.to_csv(self.filename, sep=",", index=False, mode="w" if self.header else "a", header=self.header)
+            self.header = False
+
+
+    def close(self):
+
+        self.flush()
+        if self.writer is not None:
+            self.writer.flush()
+
+        # an empty table when no row has been collected
+        if self.n_rows == 0:
+            d_empty = pd.DataFrame({"uid": pd.Series(dtype=object), "lat": pd.Series(dtype=np.float64),
+                                    "lng": pd.Series(dtype=np.float64), "timestamp": pd.Series(dtype=np.int64)})
+            self.write_chunk(d_empty)
+
+
+    def checkpoint_state(self):
+
+        # what has been written to disk so far
+        self.flush()
+        if self.writer is not None:
+            self.writer.flush()
+        size = os.path.getsize(self.filename) if self.file_format == "csv" and not self.header else 0
+
+        return {"n_rows": self.n_rows, "n_parts": self.n_parts, "header": self.header, "size": size}
+
+
+    def restore(self, state):
+
+        # drop what has been written after the checkpoint
+        self.n_rows, self.n_parts, self.header = state["n_rows"], state["n_parts"], state["header"]
+
+        if self.file_format == "parquet":
+            for f in os.listdir(self.filename):
+                if f.startswith("part-") and int(f[5:10]) >= self.n_parts:
+                    os.remove(f"{self.filename}/{f}")
+        elif os.path.exists(self.filename):
+            with open(self.filename, "r+b") as f:
+                f.truncate(state["size"])
+
+
+    def __getstate__(self):
+
+        # the background writer is attached again on restore
+        state = dict(self.__dict__)
+        state["writer"] = None
+        return state
+
+
+
+class EdgeSpeedStats:
+    '''
+    Streaming per-edge statistics of the speed (m/s): count, mean and variance
+    (Welford/Chan update of one batch of observations per step), min, max and
+    approximate quantiles from a fixed-size histogram sketch of bin_width m/s bins.
+    '''
+
+    quantiles = [0.1, 0.5, 0.9]
+
+    def __init__(self, n_edges, bin_width=1, max_speed=70):
+
+        self.bin_width = bin_width
+        self.n_bins = int(np.ceil(max_speed/bin_width)) + 1
+
+        self.count = np.zeros(n_edges, dtype=np.float64)
+        self.mean = np.zeros(n_edges, dtype=np.float64)
+        self.m2 = np.zeros(n_edges, dtype=np.float64)
+        self.min = np.full(n_edges, np.inf, dtype=np.float64)
+        self.max = np.full(n_edges, -np.inf, dtype=np.float64)
+        self.hist = np.zeros((n_edges, self.n_bins), dtype=np.uint32)
+
+
+    def update(self, edge_ind, speeds):
+
+        if len(edge_ind) == 0:
+            return
+
+        # statistics of the batch for each edge touched in this step
+        touched, inv = np.unique(edge_ind, return_inverse=True)
+        n_b = np.bincount(inv).astype(np.float64)
+        mean_b = np.bincount(inv, weights=speeds)/n_b
+        m2_b = np.bincount(inv, weights=(speeds - mean_b[inv])**2)
+
+        # merge with the running statistics
+        n_a, mean_a = self.count[touched], self.mean[touched]
+        n_ab = n_a + n_b
+        delta = mean_b - mean_a
+
+        self.mean[touched] = mean_a + delta*n_b/n_ab
+        self.m2[touched] += m2_b + delta**2*n_a*n_b/n_ab
+        self.count[touched] = n_ab
+
+        np.minimum.at(self.min, edge_ind, speeds)
+        np.maximum.at(self.max, edge_ind, speeds)
+
+        bins = np.minimum((speeds/self.bin_width).astype(np.int64), self.n_bins-1)
+        np.add.at(self.hist, (edge_ind, bins), 1)
+
+
+    def quantile(self, q):
+
+        # linear interpolation within the histogram bin containing the q-th observation
+        cum = np.cumsum(self.hist, axis=1, dtype=np.float64)
+        target = q*self.count
+
+        b = np.minimum((cum < target[:, None]).sum(axis=1), self.n_bins-1)
+        rows = np.arange(len(b))
+        cum_before = np.where(b > 0, cum[rows, np.maximum(b-1, 0)], 0)
+        in_bin = np.maximum(self.hist[rows, b], 1)
+
+        with np.errstate(invalid="ignore"):
+            values = (b + (target - cum_before)/in_bin)*self.bin_width
+            values = np.clip(values, self.min, self.max)
+
+        return np.where(self.count > 0, values, np.nan)
+
+
+    def to_columns(self):
+
+        observed = self.count > 0
+
+        with np.errstate(invalid="ignore", divide="ignore"):
+            std = np.sqrt(self.m2/(self.count-1))
+
+        columns = {"speed_count": self.count.astype(np.int64),
+                   "speed_mean": np.where(observed, self.mean, np.nan),
+                   "speed_std": np.where(self.count > 1, std, np.nan),
+                   "speed_min": np.where(observed, self.min, np.nan),
+                   "speed_max": np.where(observed, self.max, np.nan)}
+
+        for q in self.quantiles:
+            columns[f"speed_p{int(q*100)}"] = self.quantile(q)
+
+        return columns
+
+
+
+class EdgeEmissionWindows:
+    '''
+    Emissions per edge per time window of window_s seconds in a disk-backed np.memmap
+    of shape (edges, windows, pollutants) (float32, Fortran order: a window is written as
+    one contiguous run of edges per pollutant). Only the window in progress is kept in memory,
+    it is copied to the file as soon as the next one starts.
+    The JSON header next to the .dat file maps the indices to the edge IDs and the
+    pollutants (see load_edge_emission_windows in src/result_utils.py).
+    '''
+
+    dtype = np.float32
+
+    def __init__(self, filename, edge_list, pollutants, window_s, max_steps, writer=None):
+
+        self.filename = filename
+        self.writer = writer
+        self.window_s = window_s
+        self.shape = (len(edge_list), max(int(np.ceil(max_steps/window_s)), 1), len(pollutants))
+
+        self.current = np.zeros((self.shape[0], self.shape[2]), dtype=np.float64)
+        self.window = 0
+
+        self.tensor = np.memmap(f"{self.filename}.dat", dtype=self.dtype, mode="w+", shape=self.shape, order="F")
+
+        header = {"edge_ids": list(edge_list), "pollutants": list(pollutants), "window_s": window_s,
+                  "shape": list(self.shape), "dtype": np.dtype(self.dtype).name, "order": "F"}
+
+        with open(f"{self.filename}.json", "w") as f:
+            json.dump(header, f)
+
+
+    def add(self, step, edge_ind, values):
+
+        window = step // self.window_s
+        if window != self.window:
+            self.flush()
+            self.window = window
+
+        np.add.at(self.current, edge_ind, values)
+
+
+    def flush(self):
+
+        # the closed window is handed over (to the background writer, if any) and a new buffer starts
+        if self.writer is not None:
+            self.writer.submit(self.write_window, self.window, self.current)
         else:
-            collect_measures["v_edge"]["values"]["vehicle"][vehicle] = [edge_id]'''
+            self.write_window(self.window, self.current)
+        self.current = np.zeros_like(self.current)
+
+
+    def write_window(self, window, values):
+
+        # windows are written once, so a resumed run can write them again
+        if window < self.shape[1]:
+            self.tensor[:, window, :] = values
+
+
+    def close(self):
+
+        self.flush()
+        if self.writer is not None:
+            self.writer.flush()
+        self.tensor.flush()
+
+
+    def __getstate__(self):
+
+        # checkpoints hold the window in progress, not the memory-mapped file nor the writer
+        state = dict(self.__dict__)
+        state["tensor"] = None
+        state["writer"] = None
+        return state
+
+
+    def __setstate__(self, state):
+
+        self.__dict__.update(state)
+        self.tensor = np.memmap(f"{self.filename}.dat", dtype=self.dtype, mode="r+", shape=self.shape, order="F")
+
+
+
+class TileAggregator:
+    '''
+    Emissions and vehicles per tile of a tessellation per time window of window_s
+    seconds, added up during the simulation through an edge index -> tile index array
+    (-1 for the edges without a tile). Only the non-empty tiles of each closed window
+    are kept, as a long table with one row per (tile, window):
+        tile_id, window, vehicle_steps (all the vehicles on the tile summed over the steps), total_<pollutant>, ...
+    '''
+
+    def __init__(self, dict_tile_edges, edge_list, pollutants, window_s):
+
+        self.pollutants = list(pollutants)
+        self.window_s = window_s
+
+        self.tile_ids = list(dict_tile_edges)
+        edge_index = {edge_id: ind for ind, edge_id in enumerate(edge_list)}
+
+        # an edge listed in more than one tile goes to the first one
+        self.edge_tile = np.full(len(edge_list), -1, dtype=np.int64)
+        for tile_ind, tile_id in enumerate(self.tile_ids):
+            for edge_id in dict_tile_edges[tile_id]:
+                ind = edge_index.get(edge_id, -1)
+                if ind >= 0 and self.edge_tile[ind] < 0:
+                    self.edge_tile[ind] = tile_ind
+
+        self.current = np.zeros((len(self.tile_ids), len(self.pollutants)), dtype=np.float64)
+        self.vehicle_steps = np.zeros(len(self.tile_ids), dtype=np.int64)
+        self.window = 0
+
+        self.rows = {"tile": [], "window": [], "vehicle_steps": [], "values": []}
+
+
+    def add(self, step, edge_ind, values):
+
+        window = step // self.window_s
+        if window != self.window:
+            self.flush()
+            self.window = window
+
+        tile = self.edge_tile[edge_ind]
+        in_tile = tile >= 0
+
+        np.add.at(self.current, tile[in_tile], values[in_tile])
+        np.add.at(self.vehicle_steps, tile[in_tile], 1)
+
+
+    def flush(self):
+
+        touched = np.flatnonzero(self.vehicle_steps)
+
+        self.rows["tile"].append(touched)
+        self.rows["window"].append(np.full(len(touched), self.window, dtype=np.int64))
+        self.rows["vehicle_steps"].append(self.vehicle_steps[touched])
+        self.rows["values"].append(self.current[touched])
+
+        self.current[:] = 0
+        self.vehicle_steps[:] = 0
+
+
+    def to_dataframe(self):
+
+        # the window in progress is closed
+        self.flush()
+
+        tile = np.concatenate(self.rows["tile"])
+        values = np.concatenate(self.rows["values"])
+
+        d_tile = pd.DataFrame()
+        d_tile["tile_id"] = np.array(self.tile_ids, dtype=object)[tile]
+        d_tile["window"] = np.concatenate(self.rows["window"])
+        d_tile["vehicle_steps"] = np.concatenate(self.rows["vehicle_steps"])
+
+        for ind, pollutant in enumerate(self.pollutants):
+            d_tile[f"total_{pollutant}"] = values[:, ind]
+
+        return d_tile
+
+
+
+class StepProfiler:
+    '''
+    Cheap per-phase timers of the simulation loop (monotonic clock): the time elapsed
+    since the previous lap is charged to the given phase. It also keeps a histogram
+    of the step latency in log2 buckets of microseconds, the step latency against
+    the vehicles in the network (log2 buckets) and, optionally, one row per step.
+    When disabled every method returns immediately.
+    '''
+
+    def __init__(self, enabled=False, per_step=False):
+
+        self.enabled = enabled
+        self.per_step = per_step
+
+        self.phases = {}
+        self.step_phases = {}
+        self.n_steps = 0
+
+        self.latency_hist = {}
+        self.by_vehicles = {}
+        self.rows = []
+
+        self.t_step = self.t = time.perf_counter()
+
+
+    def start_step(self):
+
+        if not self.enabled:
+            return
+
+        self.t_step = self.t = time.perf_counter()
+        self.step_phases = {}
+
+
+    def lap(self, phase):
+
+        if not self.enabled:
+            return
+
+        now = time.perf_counter()
+        self.phases[phase] = self.phases.get(phase, 0) + now - self.t
+        self.step_phases[phase] = self.step_phases.get(phase, 0) + now - self.t
+        self.t = now
+
+
+    def end_step(self, step, n_vehicles):
+
+        if not self.enabled:
+            return
+
+        dt = time.perf_counter() - self.t_step
+        self.n_steps += 1
+
+        b = int(np.log2(max(dt*1e6, 1)))
+        self.latency_hist[b] = self.latency_hist.get(b, 0) + 1
+
+        b = int(np.log2(max(n_vehicles, 1))) if n_vehicles > 0 else -1
+        count, total = self.by_vehicles.get(b, (0, 0))
+        self.by_vehicles[b] = (count + 1, total + dt)
+
+        if self.per_step:
+            self.rows.append(dict({"step": step, "n_vehicles": n_vehicles, "step_time_s": dt}, **self.step_phases))
+
+
+    def summary(self):
+
+        dict_profile = {"n_steps": self.n_steps,
+                        "phases_s": {k: round(v, 4) for k, v in self.phases.items()},
+                        "step_latency_hist_us": {f"[{2**b}, {2**(b+1)})": self.latency_hist[b] for b in sorted(self.latency_hist)},
+                        "step_time_by_vehicles": []}
+
+        for b in sorted(self.by_vehicles):
+            count, total = self.by_vehicles[b]
+            dict_profile["step_time_by_vehicles"].append({"vehicles": [0, 0] if b < 0 else [2**b, 2**(b+1)-1], "n_steps": count,
+                                                          "mean_step_ms": round(total/count*1000, 4)})
+
+        return dict_profile
+
+
+    def save_steps(self, filename):
+
+        d = pd.DataFrame(self.rows)
+        d.to_csv(filename, sep=",", index=False)
+
+
+
+class MeasureStore:
+    '''
+    Collects the measures of a simulation.
+    Edges and vehicles are mapped once to dense integer indices and every measure
+    is stored in preallocated float64 arrays, so that the values of a simulation
+    step are added up with a single scatter-add.
+    The collection plan (the enabled measures and the cohorts each one collects) is
+    compiled at startup, while the cohort of a vehicle is cached at departure.
+    '''
+
+    def __init__(self, args, edge_list, vehicle_id_list, v_edge_interval=300, gps_writer=None, profiler=None):
+
+        self.modes = {measure: getattr(args, measure) for measure in measure_2_details}
+
+        # sampling of each measure: (fraction of the vehicle IDs, collected every k steps)
+        self.sampling = {}
+        for measure, mode in self.modes.items():
+            self.modes[measure], fraction, every = parse_collect_mode(mode)
+            if (fraction, every) != (1.0, 1) and measure not in sampled_measures:
+                sys.exit(f"--{measure.replace('_', '-')}: sampling is available only for "+", ".join(sampled_measures))
+            self.sampling[measure] = (fraction, every)
+        self.v_edge_interval = v_edge_interval
+
+        self.edge_list = list(edge_list)
+        self.vehicle_id_list = list(vehicle_id_list)
+
+        self.edge_index = {edge_id: ind for ind, edge_id in enumerate(self.edge_list)}
+        self.vehicle_index = {v_id: ind for ind, v_id in enumerate(self.vehicle_id_list)}
+
+        n_edges, n_vehicles = len(self.edge_list), len(self.vehicle_id_list)
+
+        # collection plan: boolean mask over the cohorts for each enabled measure
+        self.plan = {measure: np.array(collect_mode_2_cohorts.get(mode, [False, False]))
+                     for measure, mode in self.modes.items() if mode != "none"}
+
+        # one column per enabled emission measure
+        self.emissions = [m for m in emission_2_variable if m in self.plan]
+        self.emission_vars = [emission_2_variable[m] for m in self.emissions]
+        self.emission_masks = np.array([self.plan[m] for m in self.emissions], dtype=np.float64).reshape(-1, 2).T
+
+        self.edge_values = np.zeros((n_edges, len(self.emissions)), dtype=np.float64)
+        self.vehicle_values = np.zeros((n_vehicles, len(self.emissions)), dtype=np.float64)
+
+        # Traveltime from the departure and arrival events
+        self.traveltime = np.zeros(n_vehicles, dtype=np.float64)
+        self.depart_step = np.full(n_vehicles, -1, dtype=np.int64)
+        self.arrived = np.zeros(n_vehicles, dtype=bool)
+        self.n_steps = 0
+
+        self.speed = EdgeSpeedStats(n_edges) if "speed" in self.plan else None
+
+        # optional EdgeEmissionWindows and TileAggregator over the enabled emissions
+        self.emission_windows = None
+        self.tiles = None
+
+        self.gps_writer = gps_writer
+        self.profiler = profiler if profiler is not None else StepProfiler()
+
+        # Timeseries
+        # sparse (edge, window, count) triplets, one chunk per sample
+        self.v_edge = {"edge": [], "window": [], "count": []}
+        self.v_edge_windows = 0
+        self.v_step = []
+
+        # vehicles in the network: vehicle_id -> (vehicle index, cohort, hash of the ID)
+        self.active = {}
+
+        # background writer of the outputs written during the simulation (see attach_writer)
+        self.writer = None
+
+
+    def attach_writer(self, writer):
+
+        self.writer = writer
+        for output in (self.gps_writer, self.emission_windows):
+            if output is not None:
+                output.writer = writer
+
+
+    def __getstate__(self):
+
+        state = dict(self.__dict__)
+        state["writer"] = None
+        return state
+
+
+    def add_departed(self, departed_list, step):
+
+        for vehicle in departed_list:
+            cohort = cohort_rand if "background" in vehicle else cohort_real
+
+            if vehicle not in self.vehicle_index:
+                self.add_vehicle(vehicle)
+
+            # stable across runs (unlike hash()), so the same vehicles are sampled in every mix
+            v_hash = zlib.crc32(vehicle.encode())
+
+            self.active[vehicle] = (self.vehicle_index[vehicle], cohort, v_hash)
+            self.depart_step[self.vehicle_index[vehicle]] = step
+
+
+    def add_arrived(self, arrived_list, step):
+
+        # the traveltime is the number of steps between the departure and the arrival
+        for vehicle in arrived_list:
+            v_ind, cohort, _ = self.active.pop(vehicle)
+            self.arrived[v_ind] = True
+
+            if "traveltime" in self.plan and self.plan["traveltime"][cohort]:
+                self.traveltime[v_ind] = step - self.depart_step[v_ind]
+
+
+    def add_vehicle(self, vehicle):
+
+        # vehicles not known at startup (e.g., flows defined by period) get the next index,
+        # the arrays grow by doubling their capacity
+        ind = len(self.vehicle_id_list)
+        self.vehicle_index[vehicle] = ind
+        self.vehicle_id_list.append(vehicle)
+
+        if ind >= len(self.traveltime):
+            capacity = max(2*len(self.traveltime), 1)
+            self.vehicle_values = np.resize(self.vehicle_values, (capacity, len(self.emissions)))
+            self.vehicle_values[ind:] = 0
+            self.traveltime = np.resize(self.traveltime, capacity)
+            self.traveltime[ind:] = 0
+            self.depart_step = np.resize(self.depart_step, capacity)
+            self.depart_step[ind:] = -1
+            self.arrived = np.resize(self.arrived, capacity)
+            self.arrived[ind:] = False
+
+
+    def update(self, step, results_sub):
+
+        # results_sub maps each vehicle in the network to its subscription results
+        n_active = len(results_sub)
+        self.n_steps = step + 1
+        results = results_sub.values()
+
+        # unknown edges (e.g., "" while teleporting) are marked with -1
+        edge_ind = np.fromiter((self.edge_index.get(r[tc.VAR_ROAD_ID], -1) for r in results), dtype=np.int64, count=n_active)
+
+        slots = np.array([self.active[vehicle] for vehicle in results_sub], dtype=np.int64).reshape(n_active, 3)
+        v_ind, cohort, v_hash = slots[:, 0], slots[:, 1], slots[:, 2]
+
+        on_edge = edge_ind >= 0
+
+        # Emissions: single scatter-add of all the enabled emissions of the step
+        if len(self.emissions) > 0:
+            values = np.array([[r[var] for var in self.emission_vars] for r in results], dtype=np.float64).reshape(n_active, len(self.emissions))
+            values *= self.emission_masks[cohort]
+            np.add.at(self.edge_values, edge_ind[on_edge], values[on_edge])
+            np.add.at(self.vehicle_values, v_ind, values)
+
+            if self.emission_windows is not None:
+                self.emission_windows.add(step, edge_ind[on_edge], values[on_edge])
+
+        # Tiles: all the vehicles on an edge are counted, the emissions of the collected cohorts are summed
+        if self.tiles is not None:
+            tile_values = values[on_edge] if len(self.emissions) > 0 else np.zeros((int(on_edge.sum()), 0))
+            self.tiles.add(step, edge_ind[on_edge], tile_values)
+
+        # GPS
+        if "gps" in self.plan and step % self.sampling["gps"][1] == 0:
+            self.profiler.lap("update_measures")
+            vehicles, results = list(results_sub), list(results)
+            selected = np.flatnonzero(self.selected("gps", cohort, v_hash))
+            xy = np.array([results[i][tc.VAR_POSITION] for i in selected], dtype=np.float32).reshape(len(selected), 2)
+            self.gps_writer.add(step, [vehicles[i] for i in selected], xy[:, 0], xy[:, 1])
+            self.profiler.lap("gps_positions")
+
+        # Speed
+        if "speed" in self.plan and step % self.sampling["speed"][1] == 0:
+            speeds = np.fromiter((r[tc.VAR_SPEED] for r in results), dtype=np.float64, count=n_active)
+            selected = self.selected("speed", cohort, v_hash) & on_edge
+            self.speed.update(edge_ind[selected], speeds[selected])
+
+        # Vehicles per edge, sampled every v_edge_interval steps (only the non-empty edges)
+        if "v_edge" in self.plan and step % self.v_edge_interval == 0:
+            edges, counts = np.unique(edge_ind[on_edge], return_counts=True)
+            self.v_edge["edge"].append(edges.astype(np.int32))
+            self.v_edge["window"].append(np.full(len(edges), step // self.v_edge_interval, dtype=np.int32))
+            self.v_edge["count"].append(counts.astype(np.int32))
+            self.v_edge_windows = step // self.v_edge_interval + 1
+
+        # Vehicles per timestep
+        if "v_step" in self.plan:
+            self.v_step.append(int(np.count_nonzero(self.plan["v_step"][cohort])))
+
+
+    def selected(self, measure, cohort, v_hash):
+
+        # vehicles of the cohorts of the measure whose hashed ID falls in the sampled fraction
+        fraction = self.sampling[measure][0]
+        selected = self.plan[measure][cohort]
+
+        if fraction < 1:
+            selected &= v_hash < fraction*2**32
+
+        return selected
+
+
+    def edge_totals(self, measure):
+
+        if measure not in self.emissions:
+            return np.zeros(len(self.edge_list), dtype=np.float64)
+
+        return self.edge_values[:, self.emissions.index(measure)]
+
+
+    def vehicle_totals(self, measure):
+
+        n_vehicles = len(self.vehicle_id_list)
+
+        if measure == "traveltime":
+            # vehicles still running at the end: steps since the departure (censored)
+            traveltime = self.traveltime[:n_vehicles].copy()
+            running = [v_ind for v_ind, cohort, _ in self.active.values() if self.plan["traveltime"][cohort]]
+            traveltime[running] = self.n_steps - self.depart_step[running]
+            return traveltime
+
+        return self.vehicle_values[:n_vehicles, self.emissions.index(measure)]
+
+
 
 def is_measure_to_collect(collect_measures, measure):
     
-    return collect_measures[measure]["mode"] != "none"
+    return collect_measures.modes[measure] != "none"
+
+
+def parse_collect_mode(mode):
+
+    # <cohorts>[:<fraction of the vehicle IDs>][@<every k steps>], e.g. real, real:0.1, all@5, real:0.1@5
+    mode, _, every = mode.partition("@")
+    mode, _, fraction = mode.partition(":")
+
+    try:
+        fraction = float(fraction) if len(fraction) > 0 else 1.0
+        every = int(every) if len(every) > 0 else 1
+    except ValueError:
+        sys.exit(f"invalid collection mode: {mode}:{fraction}@{every}")
 
+    if not (0 < fraction <= 1) or every < 1:
+        sys.exit(f"invalid collection mode: {mode}:{fraction}@{every} (the fraction must be in (0, 1] and the step decimation at least 1)")
 
-def init_arguments(parser):
+    return mode, fraction, every
+
+
+def init_arguments(parser, batch=False):
+
+    # run_sumo.py takes the files and the output directory of a resumed run from its checkpoint
+    resume_note = "" if batch else " (not needed with --resume)"
 
     list_args = [
-    {"names": ["-n", "--net-file"], "type": str, "required": True, "help": "Load road network description from FILE."},
-    {"names": ["-r", "--route-file"], "type": str, "required": True, "help": "Load routes descriptions from FILE."},
+    {"names": ["-n", "--net-file"], "type": str, "required": batch, "help": "Load road network description from FILE"+resume_note+"."},
+    {"names": ["-r", "--route-file"], "type": str, "required": False, "help": "Load routes descriptions from FILE"+resume_note+"."},
     {"names": ["-g", "--gui"], "type": int, "required": False, "default":0, "help": "Whether to use the GUI (1) or not (0)."},
-    {"names": ["-s", "--save-dir"], "type": str, "required": True, "help": "The path of the directory in which store the simulation results."},
+    {"names": ["-s", "--save-dir"], "type": str, "required": batch, "help": "The path of the directory in which store the simulation results"+resume_note+"."},
     {"names": ["--max-hours"], "type": float, "required": False, "default":10, "help": "The maximum number of hours to simulate"},
     {"names": ["--prefix"], "type": str, "required": False, "default":"", "help": "The prefix to use for the output directory."},
     {"names": ["--co2"], "type": str, "required": False, "default":"real", "help": "Collection mode for CO2 emissions (mg/s) at edge/vehicle level: 'real' for all vehicles or 'none' for no vehicles."},
@@ -162,20 +916,52 @@ def init_arguments(parser):
         {"names": ["--noise"], "type": str, "required": False, "default":"none", "help": "Collection mode for noise emissions (dBA/s) at edge/vehicle level: 'real' for all vehicles or 'none' for no vehicles."},
     {"names": ["--fuel"], "type": str, "required": False, "default":"real", "help": "Collection mode for fuel consumption (ml/s) at edge/vehicle level: 'real' for all vehicles or 'none' for no vehicles."},
     {"names": ["--traveltime"], "type": str, "required": False, "default":"real", "help": "Collection mode for the traveltime (s): 'real' for all vehicles or 'none' for no vehicles."},
-    {"names": ["--speed"], "type": str, "required": False, "default":"none", "help": "Collection mode for speed (m/s) at edge/vehicle level: 'real' for all vehicles or 'none' for no vehicles."},
-    {"names": ["--gps"], "type": str, "required": False, "default":"none", "help": "Collection mode for GPS traces: 'real' for all vehicles while 'none' for no vehicles."},
+    {"names": ["--speed"], "type": str, "required": False, "default":"none", "help": "Collection mode for speed (m/s) at edge/vehicle level: 'real' for all vehicles or 'none' for no vehicles. Append ':F' to sample the fraction F of the vehicle IDs (hashed, the same in every run) and '@K' to collect every K steps, e.g. 'real:0.1@5'."},
+    {"names": ["--gps"], "type": str, "required": False, "default":"none", "help": "Collection mode for GPS traces: 'real' for all vehicles while 'none' for no vehicles. Append ':F' to sample the fraction F of the vehicle IDs (hashed, the same in every run) and '@K' to collect every K steps, e.g. 'real:0.1@5'."},
+    {"names": ["--gps-format"], "type": str, "required": False, "default":"csv", "choices": ["csv", "parquet"], "help": "File format of the GPS traces (parquet requires pyarrow)."},
+    {"names": ["--gps-flush-steps"], "type": int, "required": False, "default":300, "help": "Write the collected GPS points to disk every N steps."},
+    {"names": ["--gps-flush-rows"], "type": int, "required": False, "default":500000, "help": "Write the collected GPS points to disk as soon as M rows are in memory."},
+    {"names": ["--output-format"], "type": str, "required": False, "default":"csv", "choices": ["csv", "parquet"], "help": "File format of the edge, vehicle, tile, v_step and v_per_edges measures (parquet requires pyarrow and embeds the content of log.json)."},
     {"names": ["--v-edge"], "type": str, "required": False, "default":"none", "help": "Collection mode for number of vehicles per edge: 'real' for all vehicles while 'none' for no vehicles."},
+    {"names": ["--v-edge-interval"], "type": int, "required": False, "default":300, "help": "Sample the number of vehicles per edge every N steps (s)."},
+    {"names": ["--emission-window"], "type": int, "required": False, "default":0, "help": "Also sum the enabled emissions per edge per time window of N steps (s) into edge_emissions_windowed.dat (0 to disable)."},
+    {"names": ["--tile-map"], "type": str, "required": False, "default":"", "help": "Tile -> edges mapping (the JSON of create_dict_tile_edges, or an npz with the aligned arrays tile_id and edge_id) to sum the enabled emissions and the vehicles per tile into tile_measures.csv."},
+    {"names": ["--tile-window"], "type": int, "required": False, "default":300, "help": "Length (s) of the time windows of tile_measures.csv."},
     {"names": ["--v-step"], "type": str, "required": False, "default":"none", "help": "Collection mode for number of vehicles per timestep: 'real' for all vehicles while 'none' for no vehicles."},
     {"names": ["--sumo-opt"], "type": str, "required": False, "default":"", "help": "Options with which to instantiate SUMO (see https://sumo.dlr.de/docs/sumo.html#options)."},
+    {"names": ["--writer-queue"], "type": int, "required": False, "default":8, "help": "Maximum number of output chunks (GPS rows, emission windows) waiting for the background writer thread before the simulation blocks (0 to write them in the simulation loop)."},
+    {"names": ["--checkpoint-every"], "type": int, "required": False, "default":0, "help": "Save a checkpoint (SUMO state and collected measures) every N steps (0 to disable). Checkpointed runs start SUMO with the options needed for identical resumed results."},
+    {"names": ["--resume"], "type": str, "required": False, "default":"", "help": "Output directory of an interrupted run to resume from its latest complete checkpoint (the arguments of that run are reused)."},
+    {"names": ["--profile"], "type": int, "required": False, "default":0, "help": "Whether to time the phases of the simulation loop (1) or not (0); the summary is written to log.json."},
+    {"names": ["--profile-steps"], "type": int, "required": False, "default":0, "help": "With --profile 1, whether to also write the timings of every step to profile_steps.csv (1) or not (0)."},
+    {"names": ["--subscription-mode"], "type": str, "required": False, "default":"bulk", "choices": ["bulk", "vehicle"], "help": "How to retrieve the subscribed variables: 'bulk' for one call per step for all the vehicles or 'vehicle' for one call per vehicle."},
     ]
 
 
 
+    # run_batch.py: a glob of route files and a pool of workers instead of a single route file
+    # (a single run of a batch is resumed with run_sumo.py --resume)
+    if batch:
+        list_args = [d for d in list_args if "--route-file" not in d["names"] and "--resume" not in d["names"]]
+        list_args += [
+        {"names": ["-r", "--routes"], "type": str, "required": True, "help": "Glob pattern of the route files (.rou.xml) to simulate."},
+        {"names": ["-w", "--workers"], "type": int, "required": False, "default":os.cpu_count(), "help": "Maximum number of simulations running in parallel."},
+        {"names": ["--reuse-sumo"], "type": int, "required": False, "default":0, "help": "Whether each worker keeps one SUMO instance and loads the next route file into it with traci.load (1) or starts a new process per route file (0)."},
+        ]
 
     for d in list_args:
         parser.add_argument(*d["names"], **({k: d[k] for k in d if k!="names"}))
 
 
+def retrieve_subscription_results(subscription_mode):
+
+    # one call per step returning the variables of all the subscribed vehicles (both libsumo and traci)
+    if subscription_mode == "bulk":
+        return traci.vehicle.getAllSubscriptionResults()
+
+    return {vehicle: traci.vehicle.getSubscriptionResults(vehicle) for vehicle in traci.vehicle.getIDList()}
+
+
 def create_sim_id():
 
     now = datetime.now()
@@ -184,7 +970,7 @@ def create_sim_id():
     return dt_string
 
 
-def config_start_sumo(net_file, route_file, opt_options=[], use_gui=True):
+def config_start_sumo(net_file, route_file, opt_options=[], use_gui=True, reload=False):
 
     if 'SUMO_HOME' in os.environ:
         tools = os.path.join(os.environ['SUMO_HOME'], 'tools')
@@ -218,19 +1004,29 @@ def config_start_sumo(net_file, route_file, opt_options=[], use_gui=True):
     sumo_cmd = options
     #,"--no-internal-links", "True"]
     print(options)
+
+    # reload: the running SUMO instance restarts with the new options instead of a new process
+    if reload:
+        traci.load(sumo_cmd[1:])
+        return def_options, opt_options, traci.getVersion()[1]
+
     conn = traci.start(sumo_cmd)
 
     return def_options, opt_options, conn[1]
 
 
-def return_number_vehicles(route_filename):
-
-    route_xml = xml.dom.minidom.parse(route_filename)
+def load_tile_map(filename):
 
-    n_flows = len(route_xml.getElementsByTagName('flow'))
-    n_vehicles = len(route_xml.getElementsByTagName('vehicle'))
+    # {tile_id: [edge_id, ...]} from a JSON dict or from an npz of aligned tile_id/edge_id arrays
+    if filename.endswith(".npz"):
+        data = np.load(filename)
+        dict_tile_edges = {}
+        for tile_id, edge_id in zip(data["tile_id"].astype(str), data["edge_id"].astype(str)):
+            dict_tile_edges.setdefault(tile_id, []).append(edge_id)
+        return dict_tile_edges
 
-    return n_flows+n_vehicles
+    with open(filename) as f:
+        return json.load(f)
 
 
 def return_net_and_route_filenames(config_file):
@@ -243,12 +1039,99 @@ def return_net_and_route_filenames(config_file):
     return path_net, path_route
 
 
-def return_vehicles_id(route_file):
+def scan_route_file(route_filename):
+
+    # single streaming pass over the route file: every top-level element is discarded
+    # once parsed, so the memory does not depend on the size of the file
+    n_vehicles, n_flows, n_flow_vehicles, n_open_flows = 0, 0, 0, 0
+    vehicle_ids = []
+    depart_min, depart_max = None, None
+
+    def update_range(value):
+        nonlocal depart_min, depart_max
+        try:
+            t = float(value)
+        except (TypeError, ValueError):
+            # e.g. depart="triggered"
+            return
+        depart_min = t if depart_min is None else min(depart_min, t)
+        depart_max = t if depart_max is None else max(depart_max, t)
+
+    depth = 0
+    context = ElementTree.iterparse(route_filename, events=("start", "end"))
+    _, root = next(context)
+
+    for event, elem in context:
+
+        if event == "start":
+            depth += 1
+            continue
+
+        depth -= 1
+
+        if depth > 0:
+            continue
+
+        if elem.tag in ["vehicle", "trip"]:
+            n_vehicles += 1
+            vehicle_ids.append(elem.get("id"))
+            update_range(elem.get("depart"))
+
+        elif elem.tag == "flow":
+            n_flows += 1
+            update_range(elem.get("begin"))
+            update_range(elem.get("end"))
+
+            # SUMO names the vehicles of a flow as flow_id.0, flow_id.1, ...
+            # (flows with a random number of vehicles are counted apart as open flows)
+            number = flow_number_vehicles(elem)
+            if number is not None:
+                vehicle_ids += [f"{elem.get('id')}.{k}" for k in range(number)]
+                n_flow_vehicles += number
+            else:
+                n_open_flows += 1
+
+        root.clear()
+
+    return {"n_vehicles": n_vehicles, "n_flows": n_flows, "n_flow_vehicles": n_flow_vehicles, "n_open_flows": n_open_flows,
+            "vehicle_ids": vehicle_ids, "depart_min": depart_min, "depart_max": depart_max}
+
+
+def flow_number_vehicles(flow):
+
+    # number of vehicles of a <flow>: the explicit number, or one vehicle every period
+    # (or 3600/vehsPerHour) seconds from begin to end (excluded), as inserted by SUMO;
+    # None when it is random (probability, period="exp(...)") or unbounded (no end)
+    if flow.get("number") is not None:
+        return int(float(flow.get("number")))
+
+    try:
+        begin = float(flow.get("begin", 0))
+        end = float(flow.get("end"))
+        if flow.get("period") is not None:
+            period = float(flow.get("period"))
+        else:
+            period = 3600/float(flow.get("vehsPerHour"))
+    except (TypeError, ValueError, ZeroDivisionError):
+        return None
+
+    if end <= begin:
+        return 0
+
+    # tolerance for (end-begin) multiple of the period
+    return int(np.ceil((end-begin)/period - 1e-9))
+
+
+def read_net_location(net_filename):
+
+    # netOffset and projParameter of the <location> element, at the top of the net file
+    for _, elem in ElementTree.iterparse(net_filename, events=("start",)):
+        if elem.tag == "location":
+            net_offset = tuple(float(v) for v in elem.get("netOffset", "0,0").split(","))
+            return {"net_offset": net_offset, "proj_parameter": elem.get("projParameter", "!")}
 
-    route_xml = xml.dom.minidom.parse(route_file)
-    id_list = [x.attributes["id"].value for x in route_xml.getElementsByTagName('vehicle')]
+    return {"net_offset": (0.0, 0.0), "proj_parameter": "!"}
 
-    return id_list
 
 #Remember, the non-internal edges are the ones s.t. edge_id[0] != ":"
 def filter_edges_for_route(internal=False):
@@ -262,20 +1145,105 @@ def filter_edges_for_route(internal=False):
 
 
 
+# SUMO options that make a run resumable from a saved state with identical results:
+# the random number generators are saved, values are saved at full precision and all
+# the routes are loaded at startup (and thus stored in the state)
+checkpoint_sumo_options = ["--save-state.rng", "--save-state.precision", "17", "--route-steps", "0"]
+
+
+def save_checkpoint(save_dir, collect_measures, sim_variables, keep=2):
+
+    step = sim_variables["step"]
+    ckpt_dir = f"{save_dir}/checkpoints/step_{step}"
+    os.makedirs(ckpt_dir, exist_ok=True)
+
+    dict_ckpt = dict(sim_variables)
+
+    # the chunks handed to the background writer are written before the checkpoint
+    if collect_measures.writer is not None:
+        collect_measures.writer.flush()
+
+    # GPS rows collected so far are flushed, so the writer holds no pending rows
+    if collect_measures.gps_writer is not None:
+        dict_ckpt["gps_writer"] = collect_measures.gps_writer.checkpoint_state()
+
+    traci.simulation.saveState(f"{ckpt_dir}/state.xml.gz")
+
+    with open(f"{ckpt_dir}/measures.pkl", "wb") as f:
+        pickle.dump(collect_measures, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+    # checkpoint.json is written last: a checkpoint without it is incomplete and ignored
+    with open(f"{ckpt_dir}/checkpoint.json.tmp", "w") as f:
+        json.dump(dict_ckpt, f)
+    os.replace(f"{ckpt_dir}/checkpoint.json.tmp", f"{ckpt_dir}/checkpoint.json")
+
+    # keep only the most recent checkpoints
+    for old_dir in list_checkpoints(save_dir)[:-keep]:
+        shutil.rmtree(old_dir)
+
+
+def list_checkpoints(save_dir):
+
+    # complete checkpoints sorted by step
+    ckpt_root = f"{save_dir}/checkpoints"
+    if not os.path.exists(ckpt_root):
+        return []
+
+    ckpt_dirs = [f"{ckpt_root}/{d}" for d in os.listdir(ckpt_root) if os.path.exists(f"{ckpt_root}/{d}/checkpoint.json")]
+
+    return sorted(ckpt_dirs, key=lambda d: int(d.split("_")[-1]))
+
+
+def latest_checkpoint(save_dir):
+
+    ckpt_dirs = list_checkpoints(save_dir)
+    if len(ckpt_dirs) == 0:
+        sys.exit(f"no complete checkpoint in {save_dir}/checkpoints")
+
+    with open(f"{ckpt_dirs[-1]}/checkpoint.json") as f:
+        dict_ckpt = json.load(f)
+
+    return ckpt_dirs[-1], dict_ckpt
+
+
+def restore_checkpoint(ckpt_dir, dict_ckpt):
+
+    with open(f"{ckpt_dir}/measures.pkl", "rb") as f:
+        collect_measures = pickle.load(f)
+
+    # drop the GPS rows written after the checkpoint
+    if collect_measures.gps_writer is not None:
+        collect_measures.gps_writer.restore(dict_ckpt["gps_writer"])
+
+    # SUMO state and subscriptions of the vehicles in the network
+    traci.simulation.loadState(f"{ckpt_dir}/state.xml.gz")
+
+    for veh_id in traci.vehicle.getIDList():
+        traci.vehicle.subscribe(veh_id, subscription_variables)
+
+    print(f"Resumed from {ckpt_dir}")
+
+    return collect_measures
+
+
 def print_recap_measures(collect_measures):
 
-    for m in collect_measures:
-        print(f"{m}: {collect_measures[m]['mode']}")
+    for m in collect_measures.modes:
+        print(f"{m}: {collect_measures.modes[m]}")
     print("\n\n")
 
 
 
 
-def save_measures(collect_measures, edge_list, vehicle_list, save_dir):
+def save_measures(collect_measures, save_dir, output_format="csv", metadata=None):
     
-    # GPS
+    # GPS (flush the last chunk)
     if is_measure_to_collect(collect_measures, "gps"): 
-        save_dataframe_gps(collect_measures)
+        collect_measures.gps_writer.close()
+
+    # Emissions per edge per time window (write the last window)
+    if collect_measures.emission_windows is not None:
+        collect_measures.emission_windows.close()
             
     
     # EDGE-based measures as edge_id, measure_0, ... , measure_n
@@ -287,7 +1255,7 @@ def save_measures(collect_measures, edge_list, vehicle_list, save_dir):
             measures_to_save.append(measure)
             colnames.append(f"total_{measure}")
     
-    save_dataframe_edges(collect_measures, edge_list, measures_to_save, colnames, f"{save_dir}/edge_measures.csv")
+    save_dataframe_edges(collect_measures, measures_to_save, colnames, f"{save_dir}/edge_measures", output_format, metadata)
     
        
     # VEHICLE-based measures as edge_id, measure_0, ... , measure_n
@@ -299,110 +1267,95 @@ def save_measures(collect_measures, edge_list, vehicle_list, save_dir):
             measures_to_save.append(measure)
             colnames.append(f"total_{measure}")
     
-    save_dataframe_vehicles(collect_measures, vehicle_list, measures_to_save, colnames, f"{save_dir}/vehicle_measures.csv")
+    save_dataframe_vehicles(collect_measures, measures_to_save, colnames, f"{save_dir}/vehicle_measures", output_format, metadata)
             
         
+    # Emissions and vehicles per tile per time window
+    if collect_measures.tiles is not None:
+        d_tile = collect_measures.tiles.to_dataframe()
+        save_table(d_tile, f"{save_dir}/tile_measures", output_format, metadata)
+
+
     # Vehicles for timestamp
     if is_measure_to_collect(collect_measures, "v_step"):
 
         d = pd.DataFrame()
-        d["timestep"] = np.arange(len(collect_measures["v_step"]["values"]["vehicle"]))
-        d["count_vehicles"] = collect_measures["v_step"]["values"]["vehicle"]
+        d["timestep"] = np.arange(len(collect_measures.v_step))
+        d["count_vehicles"] = collect_measures.v_step
 
-        d.to_csv(f"{save_dir}/v_step.csv", sep=",", index=False)    
-    
-    
-    # Vehicles per edge
-    if is_measure_to_collect(collect_measures, "v_edge"):
-        
-        # compute n_observations
-        n_observations = len(collect_measures["v_edge"]["values"]["edge"][edge_list[0]])
-                               
-        list_columns = ["edge_id"] + [f"observation_{i+1}" for i in range(n_observations)]
-        
-        d = pd.DataFrame(columns=list_columns)
-        
-        d["edge_id"] = edge_list
-        
-        obs = {i:[] for i in range(n_observations)}
-        
-        for edge_id in collect_measures["v_edge"]["values"]["edge"]:
-            
-            obs_edge = collect_measures["v_edge"]["values"]["edge"][edge_id] 
-            
-            for j in range(len(obs_edge)):          
-                obs[j].append(obs_edge[j])
-            
-        for i in range(len(obs)):
-            d[f"observation_{i+1}"] = obs[i]
-        
-    
-        d.to_csv(f"{save_dir}/v_per_edges.csv", sep=",", index=False) 
-        
-        
-    '''
+        save_table(d, f"{save_dir}/v_step", output_format, metadata)
     
- 
-    # Speed
-    if is_measure_to_collect(collect_measures, "speed"):
-        save_dataframe_edges(collect_measures, "speed", "speed")
-    '''
     
-    # Vehicles per edge (old but gold)
-    '''
+    # Vehicles per edge as a sparse long table (see load_v_edge_matrix in src/result_utils.py)
     if is_measure_to_collect(collect_measures, "v_edge"):
+        save_v_edge(collect_measures, f"{save_dir}/v_per_edges", output_format, metadata)
+
+
+def save_table(d, filename, output_format="csv", metadata=None):
+
+    # filename without extension; parquet files carry the metadata (e.g., the content of log.json) in their schema
+    if output_format == "parquet":
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        table = pa.Table.from_pandas(d, preserve_index=False)
+        if metadata is not None:
+            table = table.replace_schema_metadata(dict(table.schema.metadata or {}, traffico2=json.dumps(metadata)))
+        pq.write_table(table, f"{filename}.parquet")
+    else:
+        d.to_csv(f"{filename}.csv", sep=",", index=False)
 
-        dict_final = {edge_id: 0 for edge_id in edge_list}
-                
-        for v in collect_measures["v_edge"]["values"]["vehicle"]:
-            edges = collect_measures["v_edge"]["values"]["vehicle"][v]
-            for e in edges:
-                dict_final[e]+=1
-                
-        collect_measures["v_edge"]["values"]["edge"] = dict_final'''
-    
-    
-        
         
-def save_dataframe_gps(collect_measures):
+def save_v_edge(collect_measures, filename, output_format="csv", metadata=None):
 
-    d_traces = pd.DataFrame()
-    d_traces['uid'] = collect_measures["gps"]["values"]["uids"]
-    d_traces['lat'] = collect_measures["gps"]["values"]["lats"]
-    d_traces['lng'] = collect_measures["gps"]["values"]["lngs"]
-    d_traces['timestamp'] = collect_measures["gps"]["values"]["timestamps"]
+    v_edge = {k: np.concatenate(collect_measures.v_edge[k]) if len(collect_measures.v_edge[k]) > 0 
+              else np.zeros(0, dtype=np.int32) for k in collect_measures.v_edge}
 
-    d_traces.to_csv(collect_measures["gps"]["filenames"]["vehicle"], sep=",", index=False)
-    
+    # parquet: one row per (edge_id, window), the sampling in the metadata
+    if output_format == "parquet":
+        d = pd.DataFrame()
+        d["edge_id"] = pd.Categorical.from_codes(v_edge["edge"], categories=collect_measures.edge_list)
+        d["window"] = v_edge["window"]
+        d["count"] = v_edge["count"]
 
-def save_dataframe_edges(collect_measures, edge_list, measures, col_names, filename):
+        metadata = dict(metadata or {}, v_edge={"interval": collect_measures.v_edge_interval, "n_windows": collect_measures.v_edge_windows})
+        save_table(d, filename, output_format, metadata)
+        return
+
+    np.savez_compressed(f"{filename}.npz", edge_id=np.array(collect_measures.edge_list), 
+                        edge=v_edge["edge"], window=v_edge["window"], count=v_edge["count"],
+                        interval=collect_measures.v_edge_interval, n_windows=collect_measures.v_edge_windows)
+
+
+def save_dataframe_edges(collect_measures, measures, col_names, filename, output_format="csv", metadata=None):
     
     d_edge = pd.DataFrame()
-    d_edge['edge_id'] = edge_list
+    d_edge['edge_id'] = collect_measures.edge_list
     
     for ind, measure in enumerate(measures):
-        list_values = []
-        for edge_id in edge_list:
-            list_values.append(collect_measures[measure]["values"]["edge"][edge_id])
-            
-        d_edge[col_names[ind]] = list_values
+        d_edge[col_names[ind]] = collect_measures.edge_totals(measure)
+
+    # Speed statistics as a group of speed_* columns
+    if is_measure_to_collect(collect_measures, "speed"):
+        for col_name, values in collect_measures.speed.to_columns().items():
+            d_edge[col_name] = values
         
-    d_edge.to_csv(filename, sep=",", index=False)
+    save_table(d_edge, filename, output_format, metadata)
 
 
-def save_dataframe_vehicles(collect_measures, vehicle_list, measures, col_names, filename):
+def save_dataframe_vehicles(collect_measures, measures, col_names, filename, output_format="csv", metadata=None):
     
     d_vehicle = pd.DataFrame()
-    d_vehicle['vehicle_id'] = vehicle_list
+    d_vehicle['vehicle_id'] = collect_measures.vehicle_id_list
     
     for ind, measure in enumerate(measures):
-        list_values = []
-        for v_id in vehicle_list:
-            list_values.append(collect_measures[measure]["values"]["vehicle"][v_id])
-            
-        d_vehicle[col_names[ind]] = list_values
+        d_vehicle[col_names[ind]] = collect_measures.vehicle_totals(measure)
+
+    # 1 for the vehicles that did not arrive (still running at the end or never departed)
+    if "traveltime" in measures:
+        d_vehicle["traveltime_censored"] = (~collect_measures.arrived[:len(collect_measures.vehicle_id_list)]).astype(np.int8)
         
-    d_vehicle.to_csv(filename, sep=",", index=False)
+    save_table(d_vehicle, filename, output_format, metadata)
 
 
 
@@ -426,12 +1379,4 @@ def print_starting_config(sim_id, use_gui, net_filename, route_filename, opt_opt
     print("Output Directory: "+save_dir)
     print("Max steps: "+str(max_steps))
     print("SUMO VERSION: "+sumo_version+"\n")
-    print("<><><><><>") 
-
-
-def is_to_collect(id_vehicle, collect_mode):
-
-    if collect_mode == "all" or (collect_mode=="rand" and "background" in id_vehicle) or (collect_mode=="real" and not "background" in id_vehicle):
-        return True
-    else:
-        return False
\ No newline at end of file
+    print("<><><><><>")